@@ -2,9 +2,10 @@ import sys
 import logging
 from statistics import median, mean
 from datetime import datetime
-from exiles_api import db_date, session, Characters, Guilds, Properties
+from exiles_api import db_date, session, Characters
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from lookups import get_wealth_ledger
 from config import ADMIN_SPREADSHEET_ID, ADMIN_CHARACTERS_SHEET_ID, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
 
 # catch unhandled exceptions
@@ -58,13 +59,18 @@ def divby10k(num):
     return float(("0." + predec.zfill(4) if len(predec) < 5 else predec[:-4] + "." + predec[-4:]) + dec)
 
 
+logger.debug("Gather wealth ledger.")
+ledger = get_wealth_ledger()
+if ledger['mismatches']:
+    logger.error(f"Wealth ledger disagreed with get_pippi_money and was computed per owner: {ledger['mismatches']}")
+
 logger.debug("Compiling the character data.")
 for c in session.query(Characters).order_by(Characters._last_login.desc()).all():
     guild_name = c.guild.name if c.guild else ''
     guild_id = c.guild.id if c.guild else ''
     disc_user = c.user.disc_user if c.user and c.user.disc_user else ''
     disc_id = c.user.disc_id if c.user and c.user.disc_id else ''
-    bronze = Properties.get_pippi_money(character_id=c.id, as_number=True)
+    bronze = ledger['characters'].get(c.id, 0)
     # try to exclude admin/support chars with access to the cheat menu from the statistics
     if c.slot == 'active' or c.slot in ('1', '2'):
         wealth.append(bronze)
@@ -83,9 +89,7 @@ for c in session.query(Characters).order_by(Characters._last_login.desc()).all()
                     c.last_login.strftime("%d-%b-%Y %H:%M")
                 ])
 
-guild_wealth = 0
-for g in session.query(Guilds).all():
-    guild_wealth += Properties.get_pippi_money(guild_id=g.id, with_chars=False, as_number=True)
+guild_wealth = sum(ledger['thespians'].values())
 
 total = divby10k(sum(wealth) + guild_wealth)
 # generate the headlines and add them to the values list
@@ -1,9 +1,10 @@
 import sys
 import logging
 from datetime import datetime
-from exiles_api import db_date, session, Guilds, Properties
+from exiles_api import db_date, session, Guilds
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from lookups import get_tiles_by_owner, get_wealth_ledger
 from config import (
     ADMIN_SPREADSHEET_ID, ADMIN_CLANS_SHEET_ID, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE, INACTIVITY, BUILDING_TILE_MULT,
     PLACEBALE_TILE_MULT
@@ -58,10 +59,17 @@ def divby10k(num):
     return float(("0." + predec.zfill(4) if len(predec) < 5 else predec[:-4] + "." + predec[-4:]) + dec)
 
 
+logger.debug("Gather tiles statistics.")
+building_pieces, placeables = get_tiles_by_owner(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT, do_round=False)
+logger.debug("Gather wealth ledger.")
+ledger = get_wealth_ledger()
+if ledger['mismatches']:
+    logger.error(f"Wealth ledger disagreed with get_pippi_money and was computed per owner: {ledger['mismatches']}")
+
 logger.debug("Compiling the character data.")
 for g in session.query(Guilds).all():
-    bronze_chars = Properties.get_pippi_money(guild_id=g.id, with_thespians=False, as_number=True)
-    bronze_no_chars = Properties.get_pippi_money(guild_id=g.id, with_chars=False, as_number=True)
+    bronze_chars = ledger['guilds'].get(g.id, 0)
+    bronze_no_chars = ledger['thespians'].get(g.id, 0)
     # try to exclude admin/support chars with access to the cheat menu from the statistics
 
     values.append([
@@ -70,7 +78,7 @@ for g in session.query(Guilds).all():
                     f"{len(g.members.active(INACTIVITY))} / {len(g.members)}",
                     divby10k(bronze_chars),
                     divby10k(bronze_no_chars),
-                    g.num_tiles(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT),
+                    int(round(building_pieces.get(g.id, 0) + placeables.get(g.id, 0))),
                     g.last_login.strftime("%d-%b-%Y %H:%M") if g.last_login else ''
                 ])
 
@@ -5,9 +5,13 @@ from datetime import datetime
 from exiles_api import ChatLogs
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from logtail import read_new_lines, save_offsets
+from localdb import (
+    add_chat_lines, replace_sheet_chat_lines, count_chat_lines, newest_chat_line, retire_chat_lines, purge_chat_lines
+)
 from config import (
-    LOGS_SPREADSHEET_ID, LOGS_CHAT_SHEET_ID, CHAT_LOG_HOLD_BACK, SAVED_DIR_PATH,
-    LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
+    LOGS_SPREADSHEET_ID, LOGS_CHAT_SHEET_ID, CHAT_LOG_HOLD_BACK, SAVED_DIR_PATH, CHAT_LOG_FILES, CHAT_LINE_MARKER,
+    CHAT_SEARCH_HOLD_BACK, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
 )
 
 # catch unhandled exceptions
@@ -40,47 +44,56 @@ values = [['Last Upload: ' + now.strftime("%d-%b-%Y %H:%M"), '', 'Hold Back Time
 sheets.update(range='Chat Log!A1:E2', values=values)
 
 # make sure there'r three rows in the sheet
-lastRow = sheets.get_properties()["gridProperties"]["rowCount"]
-if lastRow == 2:
+rowCount = sheets.get_properties()["gridProperties"]["rowCount"]
+if rowCount == 2:
     sheets.insert_rows(startIndex=3, numRows=1)
+    rowCount = 3
 sheets.set_frozen(rows=2)
 
 # threshold beyond which no dates should be kept
 ageThreshold = now - CHAT_LOG_HOLD_BACK
 
-""" Read datetimes from spreadsheet """
+""" Sync the local chat log with the spreadsheet """
 
 # ensure that sheet is sorted from olderst (row 3) to latest (second to last row)
 sheets.sort(sortCol=1, startRowIndex=3)
 sheets.commit()
-# read the datetimes of the chatlines that are already uploaded to the sheet
-datetimes = [d[0] for d in sheets.read('Chat Log!A3:A', is_ordinal=True)]
-lastRow = len(datetimes) + 2
+# the chat lines on the sheet are mirrored locally so the sheet doesn't have to be read on every run.
+# The mirror is rebuilt from the sheet if the number of rows doesn't match, e.g. on the first run or after manual edits
+numLines = count_chat_lines(on_sheet=True)
+if not numLines + 2 <= rowCount <= numLines + 3:
+    logger.info("Local chat log doesn't match the chatlog sheet. Reading chat lines from the sheet.")
+    sheetLines = [line for line in sheets.read('Chat Log!A3:E', is_ordinal=True) if line and line[0]]
+    replace_sheet_chat_lines(sheetLines)
+    numLines = len(sheetLines)
+lastRow = numLines + 2
 
 """ Remove old data from spreadsheet """
 
 logger.debug("Remove old data from chatlog sheet.")
-rowsToDelete = 0
-# remove the oldest entry while it's older than the calculated threshold and keep count
-while(len(datetimes) > 1 and datetimes[0] < ageThreshold):
-    rowsToDelete += 1
-    del datetimes[0]
+# remove all lines older than the calculated threshold but keep at least one
+rowsToDelete = min(count_chat_lines(until=ageThreshold, on_sheet=True), numLines - 1)
 
 # remove as many lines as have been counted from the top of the sheet (excluding the header)
 if rowsToDelete > 0:
     sheets.delete_rows(startIndex=3, numRows=rowsToDelete)
     sheets.commit()
+    retire_chat_lines(rowsToDelete)
     lastRow -= rowsToDelete
+# lines removed from the sheet are kept locally for the chat search a lot longer
+purge_chat_lines(now - CHAT_SEARCH_HOLD_BACK)
 
 """ Read the required chatlog lines from the logfile """
 
 logger.debug("Reading new entries from the logfile.")
-# grab the newest date for comparison. If dates is empty or date is older use ageThreshold instead
-newestDate = datetimes[-1] if datetimes and datetimes[-1] > ageThreshold else ageThreshold
-# read only the chatfiles that are not already uploaded to the sheet. Order is from oldest to newest
+# grab the newest date for comparison. If there are no lines or date is older use ageThreshold instead
+newestDate = newest_chat_line()
+newestDate = newestDate if newestDate and newestDate > ageThreshold else ageThreshold
+# only the lines appended since the last run are read, files seen for the first time are read completely
 LOGS_PATH = os.path.join(SAVED_DIR_PATH, "Logs")
 logs = ChatLogs(LOGS_PATH, newestDate)
-logs.get_lines()
+lines, offsets = read_new_lines(os.path.join(LOGS_PATH, CHAT_LOG_FILES), CHAT_LINE_MARKER)
+logger.debug(f"Read {len(lines)} new chat lines from the logfiles.")
 # delete the oldest file if there are 3 (default) or more files and use the last edit date to rename the youngest
 logs.cycle_log_files()
 
@@ -88,8 +101,11 @@ logs.cycle_log_files()
 
 logger.debug("Updating chatlog sheet with new lines.")
 values = []
-for line in logs.chat_lines:
-    values.append(logs.get_chat_info(line))
+for line in lines:
+    info = logs.get_chat_info(line)
+    # skip lines that are already on the sheet or too old, i.e. when no checkpoint existed yet
+    if info and info[0] > newestDate:
+        values.append(info)
 
 numRows = len(values)
 if numRows > 0:
@@ -102,6 +118,10 @@ if numRows > 0:
     sheets.set_filter(startRowIndex=2, endRowIndex=lastRow)
     sheets.commit()
     sheets.update(range=range, values=values)
+    add_chat_lines(values)
+
+# remember how far the logfiles have been read once the lines are safely uploaded
+save_offsets(offsets)
 
 execTime = datetime.utcnow() - now
 execTimeStr = str(execTime.seconds) + "." + str(execTime.microseconds)
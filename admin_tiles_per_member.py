@@ -2,13 +2,17 @@ import sys
 import logging
 from datetime import datetime
 from operator import itemgetter
+from difflib import SequenceMatcher
 from math import ceil, inf
-from exiles_api import db_date, session, TilesManager, MembersManager, OwnersCache
+from exiles_api import db_date, MembersManager
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from lookups import get_tiles_consolidated, get_owner_names
+from localdb import load_snapshot, store_snapshot
 from config import (
     ADMIN_SPREADSHEET_ID, ADMIN_TPM_SHEET_ID, BUILDING_TILE_MULT, PLACEBALE_TILE_MULT,
-    INACTIVITY, RUINS_CLAN_ID, ALLOWANCE_INCLUDES_INACTIVES, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
+    INACTIVITY, RUINS_CLAN_ID, ALLOWANCE_INCLUDES_INACTIVES, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE,
+    ADMIN_TPM_DIFF_UPLOAD
 )
 
 # catch unhandled exceptions
@@ -49,9 +53,11 @@ date_str = now.strftime("%d-%b-%Y %H:%M UTC")
 values = []
 
 logger.debug("Gather tiles statistics.")
-tiles = TilesManager.get_tiles_consolidated(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT)
+tiles = get_tiles_consolidated(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT)
 logger.debug("Gather member statistics.")
 members = MembersManager.get_members(INACTIVITY)
+logger.debug("Load owner names from OwnersCache.")
+ownerscache = get_owner_names()
 
 logger.debug("Compile tiles per member data.")
 for object_id, ctd in tiles.items():
@@ -62,9 +68,8 @@ for object_id, ctd in tiles.items():
     if ctd['owner_id'] in members:
         name = members[ctd['owner_id']]['name']
         if name == 'Ruins' and ctd['owner_id'] != RUINS_CLAN_ID:
-            owner = session.query(OwnersCache).get(ctd['owner_id'])
-            if owner:
-                name = owner.name + " (Ruins)"
+            if ctd['owner_id'] in ownerscache:
+                name = ownerscache[ctd['owner_id']] + " (Ruins)"
     else:
         logger.error("Object without owner! Should be moved to dedicated Ruins clan by ruins script.")
         logger.error(f"object_id: {object_id} / contents: {ctd}")
@@ -117,54 +122,122 @@ values = [
     ]
 ] + values
 
-logger.debug("Format and upload data to tiles per member sheet.")
-# set the gridsize so it fits in all the values including the two headlines
+# replace all occurrences of math.inf with ∞
+for row in values[2:]:
+    if row[6] == inf:
+        row[6] = '∞'
+
+
+def get_groups(values):
+    """
+    Little helper function that returns the (startIndex, endIndex) arguments of set_dimension_group
+    for all runs of rows sharing the same owner_id. The last group is open-ended (endIndex is None)
+    """
+    groups = []
+    # initialize some loop vars
+    prev_id = values[2][2]
+    prev_row = 2
+    multiline = False
+    for row in range(3, len(values)):
+        # compare owner_id with that of last row(s)
+        if values[row][2] == prev_id:
+            multiline = True
+        else:
+            if multiline:
+                groups.append((prev_row + 1, row))
+            multiline = False
+            prev_id = values[row][2]
+            prev_row = row
+    # ensure that last row is being grouped too if applicable
+    if multiline:
+        groups.append((prev_row + 1, None))
+    return groups
+
+
+def set_groups(groups):
+    """
+    Little helper function that ungroups everything and re-groups by owner_ids
+    """
+    sheets.delete_dimension_group()
+    sheets.set_visibility(hidden=False)
+    for startIndex, endIndex in groups:
+        if endIndex is None:
+            sheets.set_dimension_group(startIndex=startIndex, hidden=True)
+        else:
+            sheets.set_dimension_group(startIndex=startIndex, endIndex=endIndex, hidden=True)
+
+
 lastRow = len(values)
-sheets.set_grid_size(cols=9, rows=lastRow, frozen=2)
-# ungroup everything
-sheets.delete_dimension_group()
-sheets.set_visibility(hidden=False)
-# replace inf for first row
-if values[2][6] == inf:
-    values[2][6] = '∞'
-# initialize some loop vars
-prev_id = values[2][2]
-prev_row = 2
-multiline = False
-# re-group by owner_ids
-for row in range(3, lastRow):
-    # compare owner_id with that of last row(s)
-    if values[row][2] == prev_id:
-        multiline = True
-    else:
-        if multiline:
-            sheets.set_dimension_group(startIndex=prev_row + 1, endIndex=row, hidden=True)
-        multiline = False
-        prev_id = values[row][2]
-        prev_row = row
-    # replace all occurrences of math.inf with ∞
-    if values[row][6] == inf:
-        values[row][6] = '∞'
-# ensure that last row is being grouped too if applicable
-if multiline:
-    sheets.set_dimension_group(startIndex=prev_row + 1, hidden=True)
-
-# set a basic filter starting from the second headline going up to the last row
-sheets.set_filter(startRowIndex=2)
-# merge the cells of the first headline
-sheets.merge_cells(endRowIndex=1, endColumnIndex=2)
-sheets.merge_cells(startColumnIndex=3, endColumnIndex=5, endRowIndex=1)
-# format the datalines
-sheets.set_alignment(startRowIndex=3, endColumnIndex=3, horizontalAlignment='LEFT')
-sheets.set_alignment(startRowIndex=3, startColumnIndex=4, endColumnIndex=5, horizontalAlignment='RIGHT')
-sheets.set_alignment(startRowIndex=3, startColumnIndex=6, endColumnIndex=6, horizontalAlignment='CENTER')
-sheets.set_alignment(startRowIndex=3, startColumnIndex=7, endColumnIndex=7, horizontalAlignment='RIGHT')
-sheets.set_alignment(startRowIndex=3, startColumnIndex=8, endColumnIndex=9, horizontalAlignment='LEFT')
-sheets.set_format(startColumnIndex=4, endColumnIndex=5, startRowIndex=3, type='NUMBER', pattern='#,##0.00')
-sheets.set_format(startColumnIndex=7, endColumnIndex=7, startRowIndex=3, type='NUMBER', pattern='#,##0')
-# update the cells with the values
-sheets.commit()
-sheets.update('Tiles per member!A1:I' + str(lastRow), values)
+groups = get_groups(values)
+# the rows uploaded last time are kept locally so only the differences need to be sent
+previous = load_snapshot('admin_tpm_sheet', ADMIN_TPM_SHEET_ID) if ADMIN_TPM_DIFF_UPLOAD else None
+# the sheet must still hold exactly the rows of the last upload, checked by size and by the object ids in column A
+if previous and (
+    previous['lastRow'] != sheets.get_properties()["gridProperties"]["rowCount"]
+    or [row[0] if row else '' for row in sheets.read('Tiles per member!A3:A', is_ordinal=True)]
+    != [row[0] for row in previous['values'][2:]]
+):
+    logger.info("Tiles per member sheet has been changed since the last upload. Uploading everything.")
+    previous = None
+
+if previous is None:
+    logger.debug("Format and upload data to tiles per member sheet.")
+    # set the gridsize so it fits in all the values including the two headlines
+    sheets.set_grid_size(cols=9, rows=lastRow, frozen=2)
+    # ungroup everything and re-group by owner_ids
+    set_groups(groups)
+    # set a basic filter starting from the second headline going up to the last row
+    sheets.set_filter(startRowIndex=2)
+    # merge the cells of the first headline
+    sheets.merge_cells(endRowIndex=1, endColumnIndex=2)
+    sheets.merge_cells(startColumnIndex=3, endColumnIndex=5, endRowIndex=1)
+    # format the datalines
+    sheets.set_alignment(startRowIndex=3, endColumnIndex=3, horizontalAlignment='LEFT')
+    sheets.set_alignment(startRowIndex=3, startColumnIndex=4, endColumnIndex=5, horizontalAlignment='RIGHT')
+    sheets.set_alignment(startRowIndex=3, startColumnIndex=6, endColumnIndex=6, horizontalAlignment='CENTER')
+    sheets.set_alignment(startRowIndex=3, startColumnIndex=7, endColumnIndex=7, horizontalAlignment='RIGHT')
+    sheets.set_alignment(startRowIndex=3, startColumnIndex=8, endColumnIndex=9, horizontalAlignment='LEFT')
+    sheets.set_format(startColumnIndex=4, endColumnIndex=5, startRowIndex=3, type='NUMBER', pattern='#,##0.00')
+    sheets.set_format(startColumnIndex=7, endColumnIndex=7, startRowIndex=3, type='NUMBER', pattern='#,##0')
+    # update the cells with the values
+    sheets.commit()
+    sheets.update('Tiles per member!A1:I' + str(lastRow), values)
+else:
+    logger.debug("Upload changes to tiles per member sheet.")
+    old_rows = [tuple(row) for row in previous['values'][2:]]
+    new_rows = [tuple(row) for row in values[2:]]
+    opcodes = SequenceMatcher(None, old_rows, new_rows, autojunk=False).get_opcodes()
+    # insert and delete rows from the bottom up so the row numbers of the old rows above remain valid.
+    # Data row i is sheet row i + 3. Inserted rows inherit the formatting of their neighbouring data rows
+    resized = False
+    for tag, i1, i2, j1, j2 in reversed(opcodes):
+        num_old, num_new = i2 - i1, j2 - j1
+        if num_old > num_new:
+            sheets.delete_rows(startIndex=i1 + num_new + 3, numRows=num_old - num_new)
+            resized = True
+        elif num_new > num_old:
+            sheets.insert_rows(
+                startIndex=i1 + num_old + 3, numRows=num_new - num_old, inheritFromBefore=i1 + num_old > 0)
+            resized = True
+    # inserted or deleted rows shift the existing groups so they're set anew whenever rows move
+    if resized or groups != previous['groups']:
+        set_groups(groups)
+        sheets.set_filter(startRowIndex=2)
+        sheets.commit()
+    # all changes go up in a single update. Rows that haven't changed are sent as empty cells (None),
+    # which the sheets api skips, so everything up to the last changed row takes just one request
+    upload = values[:2] + [[None] * 9 for row in new_rows]
+    # the headlines contain the upload date so they're always updated
+    lastChanged, num_changed = 2, 0
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag in ('replace', 'insert'):
+            upload[j1 + 2:j2 + 2] = values[j1 + 2:j2 + 2]
+            lastChanged, num_changed = j2 + 2, num_changed + j2 - j1
+    sheets.update(f"Tiles per member!A1:I{lastChanged}", upload[:lastChanged])
+    logger.info(f"Uploaded {num_changed} changed rows out of {len(new_rows)} rows in one update.")
+
+if ADMIN_TPM_DIFF_UPLOAD:
+    store_snapshot('admin_tpm_sheet', ADMIN_TPM_SHEET_ID, {'lastRow': lastRow, 'values': values, 'groups': groups})
 
 execTime = datetime.utcnow() - now
 execTimeStr = str(execTime.seconds) + "." + str(execTime.microseconds)
@@ -1,10 +1,24 @@
 import os
 import sys
 import logging
+import gzip
+import json
 import shutil
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+from time import sleep, time
+from pathlib import Path
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from logger import get_logger
-from config import LOG_LEVEL_STDOUT, LOG_LEVEL_FILE, SAVED_DIR_PATH, BACKUP_DIR_PATH, FILES_TO_BACKUP
+from config import (
+    LOG_LEVEL_STDOUT, LOG_LEVEL_FILE, SAVED_DIR_PATH, BACKUP_DIR_PATH, FILES_TO_BACKUP, BACKUP_MODE,
+    BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP, BACKUP_STORE_PATH, BACKUP_CHUNK_SIZE, BACKUP_WORKERS,
+    BACKUP_COMPRESS_LEVEL, BACKUP_WATCH_INTERVAL, BACKUP_WATCH_STALL
+)
 
 # catch unhandled exceptions
 logger = get_logger('backup.log', log_level_stdout=LOG_LEVEL_STDOUT, log_level_file=LOG_LEVEL_FILE)
@@ -20,97 +34,445 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = handle_exception
 
-# save current time
-now = datetime.utcnow()
-if LOG_LEVEL_STDOUT > logging.INFO:
-    print("Checking if backup is required...")
-logger.info("Checking if backup is required...")
-
-# try getting the date of the last entry of the logfile
+# number of bytes read and written at once when compressing, decompressing or hashing files
+BLOCK_SIZE = 1024 * 1024
+# number of bytes read at once when reading the logfile backwards
+TAIL_BLOCK_SIZE = 4096
+# seconds a chunk is kept at least, a backup that's still running may not have written its manifest yet
+PRUNE_GRACE = 3600
+# the logfile of the server which is used to determine the time of a crash
 logfile = os.path.join(SAVED_DIR_PATH, 'Logs', 'ConanSandbox.log')
-try:
-    with open(logfile, 'r') as f:
-        lines = f.readlines()
-        log_dt = datetime.strptime(lines[-1][1:20], '%Y.%m.%d-%H.%M.%S')
-
-# if file doesn't, exist exit with error message
-except Exception as e:
-    logger.error("Error:", e)
-    sys.exit()
 
-# get the list of files and directories at the configured backup path
-try:
-    directories = os.listdir(BACKUP_DIR_PATH)
 
-# if path doesn't, exist exit with error message
-except Exception as e:
-    logger.error("Error:", e)
-    sys.exit()
+class HashingWriter:
+    """
+    Little helper class that passes everything written to it on to the file f while keeping
+    track of the number of bytes written and their sha256 hash
+    """
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        return self.f.write(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+def hash_file(path):
+    """
+    Returns the size and the sha256 hash of the file at path
+    """
+    size = 0
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while block := f.read(BLOCK_SIZE):
+            size += len(block)
+            sha256.update(block)
+    return size, sha256.hexdigest()
+
+
+def read_last_line(path):
+    """
+    Returns the last line of the file at path by reading it backwards from the end in blocks
+    so only the end of the file has to be read no matter how large the file is
+    """
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        data = b''
+        pos = end
+        while pos > 0:
+            pos = max(pos - TAIL_BLOCK_SIZE, 0)
+            f.seek(pos)
+            data = f.read(end - pos)
+            # a line break before the last line (ignoring the one terminating it) marks its start
+            if data.rstrip(b'\r\n').rfind(b'\n') >= 0:
+                break
+    return data.rstrip(b'\r\n').rsplit(b'\n', 1)[-1].decode('utf-8', errors='replace')
+
+
+def is_sqlite_db(path):
+    """
+    Little helper function that checks if the file at path is an SQLite database by its header
+    """
+    with open(path, 'rb') as f:
+        return f.read(16) == b'SQLite format 3\x00'
+
+
+def backup_db(path, backupdir):
+    """
+    Copies the SQLite database at path into backupdir using SQLite's online backup API. The pages
+    are copied BACKUP_PAGES_PER_STEP at a time with a pause of BACKUP_STEP_SLEEP seconds between
+    the steps so the server can keep writing to the database while the consistent copy is made
+    """
+    dest = os.path.join(backupdir, os.path.basename(path))
+
+    def pause(status, remaining, total):
+        if remaining:
+            sleep(BACKUP_STEP_SLEEP)
+
+    with closing(sqlite3.connect(Path(path).resolve().as_uri() + '?mode=ro', uri=True)) as src, \
+            closing(sqlite3.connect(dest)) as dst:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=pause)
+    shutil.copystat(path, dest)
+
+
+def store_chunks(path):
+    """
+    Splits the file at path into chunks of BACKUP_CHUNK_SIZE bytes and stores every chunk that isn't
+    in the store yet under its sha256 hash. Returns the list of chunk hashes and the number of bytes written
+    """
+    hashes = []
+    written = 0
+    with open(path, 'rb') as f:
+        while chunk := f.read(BACKUP_CHUNK_SIZE):
+            digest = hashlib.sha256(chunk).hexdigest()
+            chunk_path = os.path.join(BACKUP_STORE_PATH, digest[:2], digest)
+            if not os.path.exists(chunk_path):
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+                # every writer uses its own temporary file since files backed up in parallel may share chunks
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(chunk_path), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as c:
+                    c.write(chunk)
+                try:
+                    os.replace(tmp_path, chunk_path)
+                    written += len(chunk)
+                except OSError:
+                    os.remove(tmp_path)
+                    # another writer stored the same chunk in the meantime
+                    if not os.path.exists(chunk_path):
+                        raise
+            hashes.append(digest)
+    return hashes, written
+
+
+def dedup_file(path):
+    """
+    Adds the file at path to the chunk store and returns its manifest entry. Databases are copied
+    with the online backup API to a temporary file first so the stored chunks are consistent
+    """
+    stat = os.stat(path)
+    if is_sqlite_db(path):
+        os.makedirs(BACKUP_STORE_PATH, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=BACKUP_STORE_PATH) as tmpdir:
+            backup_db(path, tmpdir)
+            snapshot = os.path.join(tmpdir, os.path.basename(path))
+            size = os.path.getsize(snapshot)
+            hashes, written = store_chunks(snapshot)
+    else:
+        size = stat.st_size
+        hashes, written = store_chunks(path)
+    logger.info(f"Stored {written} new of {size} bytes of {os.path.basename(path)} in the chunk store.")
+    return {'size': size, 'mtime': stat.st_mtime, 'chunks': hashes}
+
+
+def compress_file(path, backupdir):
+    """
+    Streams the file at path through gzip into backupdir and returns its manifest entry with the size
+    and sha256 hash of both the original and the compressed file. Databases are copied with the online
+    backup API to a temporary file first so the compressed copy is consistent
+    """
+    stat = os.stat(path)
+    name = os.path.basename(path)
+    with tempfile.TemporaryDirectory(dir=backupdir) as tmpdir:
+        source = path
+        if is_sqlite_db(path):
+            backup_db(path, tmpdir)
+            source = os.path.join(tmpdir, name)
+        size = 0
+        sha256 = hashlib.sha256()
+        with open(source, 'rb') as src, open(os.path.join(backupdir, name + '.gz'), 'wb') as f:
+            out = HashingWriter(f)
+            with gzip.GzipFile(name, 'wb', BACKUP_COMPRESS_LEVEL, out, stat.st_mtime) as gz:
+                while block := src.read(BLOCK_SIZE):
+                    size += len(block)
+                    sha256.update(block)
+                    gz.write(block)
+    return {
+        'size': size, 'mtime': stat.st_mtime, 'sha256': sha256.hexdigest(),
+        'file': name + '.gz', 'compressed_size': out.size, 'compressed_sha256': out.sha256.hexdigest()
+    }
+
+
+def backup_file(path, backupdir):
+    """
+    Copies the file at path into backupdir. Databases are copied with the online backup API if
+    BACKUP_MODE is 'online', all other files are simply copied. In 'dedup' mode the file is added
+    to the chunk store instead and in 'compress' mode it's compressed, both return its manifest entry
+    """
+    if BACKUP_MODE == 'dedup':
+        return dedup_file(path)
+    if BACKUP_MODE == 'compress':
+        return compress_file(path, backupdir)
+    if BACKUP_MODE == 'online' and is_sqlite_db(path):
+        backup_db(path, backupdir)
+    else:
+        shutil.copy2(path, backupdir)
+
+
+def restore(backupdir, dest):
+    """
+    Rebuilds all files listed in the manifest of the deduplicated or compressed backup in backupdir into dest
+    """
+    with open(os.path.join(backupdir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    os.makedirs(dest, exist_ok=True)
+    for name, entry in manifest.items():
+        path = os.path.join(dest, name)
+        with open(path + '.tmp', 'wb') as f:
+            if 'chunks' in entry:
+                for digest in entry['chunks']:
+                    with open(os.path.join(BACKUP_STORE_PATH, digest[:2], digest), 'rb') as c:
+                        f.write(c.read())
+            else:
+                with gzip.open(os.path.join(backupdir, entry['file']), 'rb') as gz:
+                    shutil.copyfileobj(gz, f, BLOCK_SIZE)
+        if os.path.getsize(path + '.tmp') != entry['size']:
+            raise RuntimeError(f"Restored {name} doesn't have the expected size of {entry['size']} bytes.")
+        os.replace(path + '.tmp', path)
+        os.utime(path, (entry['mtime'], entry['mtime']))
+        logger.info(f"Restored {name} to {dest}.")
+
+
+def verify(backupdir, full=False):
+    """
+    Checks the files of the deduplicated or compressed backup in backupdir against its manifest and
+    returns the number of errors found. Compressed files are checked by the hash of the compressed
+    file, only if full is True they're decompressed to check the hash of the original file as well
+    """
+    with open(os.path.join(backupdir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    errors = 0
+    for name, entry in manifest.items():
+        if 'chunks' in entry:
+            size = 0
+            for digest in entry['chunks']:
+                chunk_path = os.path.join(BACKUP_STORE_PATH, digest[:2], digest)
+                if not os.path.exists(chunk_path) or hash_file(chunk_path)[1] != digest:
+                    logger.error(f"Chunk {digest} of {name} is missing or damaged.")
+                    errors += 1
+                else:
+                    size += os.path.getsize(chunk_path)
+            if size != entry['size']:
+                logger.error(f"Chunks of {name} add up to {size} instead of {entry['size']} bytes.")
+                errors += 1
+            continue
+        path = os.path.join(backupdir, entry['file'])
+        if not os.path.exists(path) or hash_file(path) != (entry['compressed_size'], entry['compressed_sha256']):
+            logger.error(f"Compressed file {entry['file']} is missing or damaged.")
+            errors += 1
+        elif full:
+            size = 0
+            sha256 = hashlib.sha256()
+            with gzip.open(path, 'rb') as gz:
+                while block := gz.read(BLOCK_SIZE):
+                    size += len(block)
+                    sha256.update(block)
+            if (size, sha256.hexdigest()) != (entry['size'], entry['sha256']):
+                logger.error(f"Decompressed {name} doesn't match its size or hash in the manifest.")
+                errors += 1
+    logger.info(f"Verified {len(manifest)} files in {backupdir} with {errors} errors.")
+    return errors
+
+
+def prune():
+    """
+    Deletes all chunks (and leftover temporary files) from the chunk store that aren't referenced by the
+    manifest of any backup in BACKUP_DIR_PATH anymore, i.e. after old backup folders have been deleted
+    """
+    referenced = set()
+    for manifest_path in Path(BACKUP_DIR_PATH).rglob('manifest.json'):
+        with open(manifest_path) as f:
+            for entry in json.load(f).values():
+                referenced.update(entry.get('chunks', []))
+    removed = 0
+    freed = 0
+    for path in Path(BACKUP_STORE_PATH).glob('[0-9a-f][0-9a-f]/*'):
+        stat = path.stat()
+        if path.is_file() and path.name not in referenced and time() - stat.st_mtime >= PRUNE_GRACE:
+            path.unlink()
+            removed += 1
+            freed += stat.st_size
+    logger.info(f"Pruned {removed} files with {freed} bytes from the chunk store, {len(referenced)} chunks are in use.")
 
-# check if an entry for the date of the crash exists starting from the last directory
-backupdir = None
-directories.sort(reverse=True)
-for directory in directories:
+
+def check():
+    """
+    Makes a backup if the last entry of the logfile is not within 5 minutes of the latest backup,
+    i.e. if the server crashed instead of being shut down by the launcher which makes its own backup
+    """
+    # try getting the date of the last entry of the logfile
     try:
-        dir_d = datetime.strptime(directory, '%Y.%m.%d')
-    except Exception:
-        # not a date, skip over
-        continue
-
-    # directory for the date in the logfile already exists
-    if dir_d.date() == log_dt.date():
-        backupdir = os.path.join(BACKUP_DIR_PATH, directory)
-        break
-
-    # if the last directory is older than the logfile, a new directory has to be created
-    elif dir_d < log_dt:
-        backupdir = os.path.join(BACKUP_DIR_PATH, log_dt.strftime('%Y.%m.%d'))
-        os.mkdir(backupdir)
-        break
+        log_dt = datetime.strptime(read_last_line(logfile)[1:20], '%Y.%m.%d-%H.%M.%S')
 
-# if no backup directory was either found or created, exit script
-if not backupdir:
-    logger.error(f"Couldn't find or create backup folder {log_dt.strftime('%Y.%m.%d')} in {BACKUP_DIR_PATH}.")
-    sys.exit()
+    # if file doesn't, exist exit with error message
+    except Exception as e:
+        logger.error("Error:", e)
+        return
 
-# get the list of files and directories at the path matching the date
-directories = os.listdir(backupdir)
-directories.sort(reverse=True)
-dir_t = None
-for directory in directories:
+    # get the list of files and directories at the configured backup path
     try:
-        dir_t = datetime.strptime(directory, '%H.%M.%S').time()
-        break
-    except Exception:
-        # not a date, skip over
-        continue
-
-# if no directory with a valid time is in backupdir, one has to be created
-if not dir_t:
-    dir_t = log_dt.strftime('%H.%M.%S')
-    backupdir = os.path.join(backupdir, dir_t)
-    os.mkdir(backupdir)
-# if the latest valid timestamp is not within 5 minutes of the time of the log, create a new directory as well
-elif (log_dt - timedelta(minutes=5)) > datetime.combine(dir_d, dir_t):
-    dir_t = log_dt.strftime('%H.%M.%S')
-    backupdir = os.path.join(backupdir, dir_t)
-    os.mkdir(backupdir)
-# a valid timestamp was found an it's within 5 minutes of the time of the log, DSL backup worked correctly
-else:
+        directories = os.listdir(BACKUP_DIR_PATH)
+
+    # if path doesn't, exist exit with error message
+    except Exception as e:
+        logger.error("Error:", e)
+        return
+
+    # check if an entry for the date of the crash exists starting from the last directory
     backupdir = None
+    directories.sort(reverse=True)
+    for directory in directories:
+        try:
+            dir_d = datetime.strptime(directory, '%Y.%m.%d')
+        except Exception:
+            # not a date, skip over
+            continue
 
-# if a new folder was created, copy all the relevant files there
-if backupdir:
-    for file in FILES_TO_BACKUP:
+        # directory for the date in the logfile already exists
+        if dir_d.date() == log_dt.date():
+            backupdir = os.path.join(BACKUP_DIR_PATH, directory)
+            break
+
+        # if the last directory is older than the logfile, a new directory has to be created
+        elif dir_d < log_dt:
+            backupdir = os.path.join(BACKUP_DIR_PATH, log_dt.strftime('%Y.%m.%d'))
+            os.mkdir(backupdir)
+            break
+
+    # if no backup directory was either found or created, exit script
+    if not backupdir:
+        logger.error(f"Couldn't find or create backup folder {log_dt.strftime('%Y.%m.%d')} in {BACKUP_DIR_PATH}.")
+        return
+
+    # get the list of files and directories at the path matching the date
+    directories = os.listdir(backupdir)
+    directories.sort(reverse=True)
+    dir_t = None
+    for directory in directories:
         try:
-            shutil.copy2(file, backupdir)
-            logger.info(f"Copying {os.path.basename(file)} to backup folder.")
-        except Exception as error:
-            # Errno 2 is 'No such file or directory'
-            if error.args[0] == 2:
-                pass
-            else:
-                logger.error(str(error))
+            dir_t = datetime.strptime(directory, '%H.%M.%S').time()
+            break
+        except Exception:
+            # not a date, skip over
+            continue
+
+    # if no directory with a valid time is in backupdir, one has to be created
+    if not dir_t:
+        dir_t = log_dt.strftime('%H.%M.%S')
+        backupdir = os.path.join(backupdir, dir_t)
+        os.mkdir(backupdir)
+    # if the latest valid timestamp is not within 5 minutes of the time of the log, create a new directory as well
+    elif (log_dt - timedelta(minutes=5)) > datetime.combine(dir_d, dir_t):
+        dir_t = log_dt.strftime('%H.%M.%S')
+        backupdir = os.path.join(backupdir, dir_t)
+        os.mkdir(backupdir)
+    # a valid timestamp was found an it's within 5 minutes of the time of the log, DSL backup worked correctly
+    else:
+        backupdir = None
+
+    # if a new folder was created, copy all the relevant files there
+    if backupdir:
+        manifest = {}
+        # the files are backed up in parallel, errors are handled file by file in the order of FILES_TO_BACKUP
+        with ThreadPoolExecutor(BACKUP_WORKERS) as executor:
+            futures = {file: executor.submit(backup_file, file, backupdir) for file in FILES_TO_BACKUP}
+        for file, future in futures.items():
+            try:
+                entry = future.result()
+                # dedup_file reports what it stored in the chunk store itself
+                if BACKUP_MODE == 'compress':
+                    logger.info(
+                        f"Compressed {os.path.basename(file)} into backup folder "
+                        f"({entry['compressed_size']} of {entry['size']} bytes)."
+                    )
+                elif BACKUP_MODE != 'dedup':
+                    logger.info(f"Copying {os.path.basename(file)} to backup folder.")
+                if entry:
+                    manifest[os.path.basename(file)] = entry
+            except Exception as error:
+                # files to backup that don't exist are skipped, every other error has to be reported
+                if isinstance(error, FileNotFoundError) and error.filename == file:
+                    pass
+                else:
+                    logger.error(f"Backup of {os.path.basename(file)} failed: {error}")
+        # deduplicated and compressed backups come with a manifest describing each file
+        if manifest:
+            with open(os.path.join(backupdir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            if BACKUP_MODE == 'compress':
+                verify(backupdir)
+
+
+def watch():
+    """
+    Polls size and mtime of the logfile every BACKUP_WATCH_INTERVAL seconds and runs check as soon as
+    the logfile stopped advancing for BACKUP_WATCH_STALL seconds. Afterwards it waits for the logfile
+    to advance again, i.e. for the server to be restarted, before watching for the next stall
+    """
+    logger.info(f"Watching {logfile} for the server to stop writing to it.")
+    last_state = None
+    last_change = time()
+    armed = False
+    while True:
+        try:
+            stat = os.stat(logfile)
+            state = (stat.st_size, stat.st_mtime)
+        except OSError:
+            state = None
+        if state != last_state:
+            last_state = state
+            last_change = time()
+            armed = state is not None
+        elif armed and time() - last_change >= BACKUP_WATCH_STALL:
+            logger.info(f"Logfile hasn't advanced for {BACKUP_WATCH_STALL} sec.")
+            # a failed check must not end the watch, the next stall is checked for anyway
+            try:
+                check()
+            except Exception:
+                logger.exception("Checking for a required backup failed.")
+            armed = False
+        sleep(BACKUP_WATCH_INTERVAL)
+
+
+parser = argparse.ArgumentParser(description="Backs up the server files after a crash and restores backups.")
+parser.add_argument('command', nargs='?', choices=('check', 'watch', 'restore', 'verify', 'prune'), default='check',
+                    help="'check' makes a backup if the server crashed (default), 'watch' keeps checking "
+                         "whenever the logfile stops advancing, 'restore' restores a backup, 'verify' checks "
+                         "a backup against its manifest and 'prune' deletes chunks no backup refers to anymore")
+parser.add_argument('backupdir', nargs='?', help="backup folder containing the manifest.json to restore or verify")
+parser.add_argument('--dest', help="folder to restore the files into (default: the backup folder)")
+parser.add_argument('--full', action='store_true', help="also decompress compressed files when verifying")
+args = parser.parse_args()
+
+if args.command in ('restore', 'verify') and not args.backupdir:
+    parser.error(f"{args.command} requires the backup folder")
+# only deduplicated and compressed backups have a manifest, others are plain copies of the files
+if args.command in ('restore', 'verify') and not os.path.isfile(os.path.join(args.backupdir, 'manifest.json')):
+    parser.error(f"{args.backupdir} has no manifest.json, {args.command} only works on 'dedup' and 'compress' backups")
+if args.command == 'restore':
+    restore(args.backupdir, args.dest or args.backupdir)
+    sys.exit()
+if args.command == 'verify':
+    sys.exit(1 if verify(args.backupdir, args.full) else 0)
+if args.command == 'prune':
+    prune()
+    sys.exit()
+
+# save current time
+now = datetime.utcnow()
+if LOG_LEVEL_STDOUT > logging.INFO:
+    print("Checking if backup is required...")
+logger.info("Checking if backup is required...")
+
+if args.command == 'watch':
+    watch()
+else:
+    check()
 
 execTime = datetime.utcnow() - now
 execTimeStr = str(execTime.seconds) + "." + str(execTime.microseconds)
@@ -0,0 +1,71 @@
+import sys
+import logging
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+from logger import get_logger
+from localdb import search_chat_lines
+from config import LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
+
+# catch unhandled exceptions
+logger = get_logger('chat_search.log', log_level_stdout=LOG_LEVEL_STDOUT, log_level_file=LOG_LEVEL_FILE)
+
+
+def handle_exception(exc_type, exc_value, exc_traceback):
+    if issubclass(exc_type, KeyboardInterrupt):
+        sys.__excepthook__(exc_type, exc_value, exc_traceback)
+        return
+
+    logger.error("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
+
+
+sys.excepthook = handle_exception
+
+
+def to_datetime(value):
+    """
+    Little helper function that parses dates given as YYYY-MM-DD or YYYY-MM-DD HH:MM for argparse
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: '{value}'")
+
+
+def to_end_of_day(value):
+    """
+    Like to_datetime but a date without time stands for the end of that day so it's included as a whole
+    """
+    date = to_datetime(value)
+    if len(value) <= len('YYYY-MM-DD'):
+        date += timedelta(days=1, microseconds=-1)
+    return date
+
+
+parser = argparse.ArgumentParser(description="Searches the chat lines kept locally by admin_process_chatlogs.")
+parser.add_argument('text', nargs='?', help="full-text query on the chat message, e.g. 'raid OR offline'")
+parser.add_argument('--sender', help="only lines whose sender contains this")
+parser.add_argument('--channel', help="only lines sent in this channel")
+parser.add_argument('--since', type=to_datetime, help="only lines sent on or after this date (UTC)")
+parser.add_argument('--until', type=to_end_of_day,
+                    help="only lines sent on or before this date (UTC), a date alone includes that whole day")
+parser.add_argument('--limit', type=int, default=100, help="max. number of (newest) lines to show (default 100)")
+args = parser.parse_args()
+
+# save current time
+now = datetime.utcnow()
+logger.debug(f"Searching chat lines: {vars(args)}")
+
+try:
+    lines = search_chat_lines(args.text, args.sender, args.channel, args.since, args.until, args.limit)
+# malformed full-text queries such as unbalanced quotes are rejected by SQLite
+except sqlite3.OperationalError as error:
+    parser.error(f"invalid search query '{args.text}': {error}")
+for date, sender, channel, type, message in lines:
+    print(f"{date.strftime('%d-%b-%Y %H:%M:%S')} [{channel}] {sender}: {message}")
+
+execTime = datetime.utcnow() - now
+execTimeStr = str(execTime.seconds) + "." + str(execTime.microseconds)
+if LOG_LEVEL_STDOUT > logging.INFO:
+    print(f"Found {len(lines)} lines. Required time: {execTimeStr} sec.")
+logger.info(f"Found {len(lines)} lines. Required time: {execTimeStr} sec.")
@@ -13,7 +13,11 @@ INACTIVITY = timedelta(weeks=2)          # time before a character or clan is co
 LONG_INACTIVE = timedelta(days=30)       # Number of days before a character is deleted from the db.
 PURGE = timedelta(days=5)                # Number of days before a base is being purged from the db.
 EVENT_LOG_HOLD_BACK = timedelta(days=7)  # number of days to keep in the event log of the game.db
+EVENT_LOG_CULL_BATCH = 10000             # max. number of events deleted from the event log per transaction
 CHAT_LOG_HOLD_BACK = timedelta(days=14)  # number of days to keep in the chat log of the google sheet
+CHAT_LOG_FILES = 'ConanSandbox*.log'     # server logfiles in the Logs dir the chat lines are read from
+CHAT_LINE_MARKER = 'ChatWindow:'         # only lines containing this are considered chat lines
+CHAT_SEARCH_HOLD_BACK = timedelta(days=365)  # number of days to keep chat lines locally for chat_search
 RUINS_CLAN_ID = -20                      # id of the clan that all ownerless objects are moved into
 MIN_DIST = 50000                         # Min. distance that for a row to be listed on the google sheet.
 OWNER_WHITELIST = list(range(-19, 0)) + [137, 91720, 297672]
@@ -52,6 +56,7 @@ PLACEBALE_TILE_RATIO = 1/3              # Ratio of total tiles that may be place
 PLAYER_ACTIVITY_SPREADSHEET_ID = PLAYER_SPREADSHEET_ID
 PLAYER_ACTIVITY_SHEET_ID = os.getenv('PLAYER_ACTIVITY_SHEET_ID')
 ACTIVITY_HOLD_BACK = timedelta(weeks=1)  # duration that the activity chart should keep
+ACTIVITY_ROLLUPS = False                 # keep hourly, daily and hour of week population rollups locally
 MAX_POP = 70                             # the maximum number of players allowed on the server
 
 """ Admin sheets """
@@ -60,6 +65,7 @@ ADMIN_CHARACTERS_SHEET_ID = os.getenv('ADMIN_CHARACTERS_SHEET_ID')
 ADMIN_CLANS_SHEET_ID = os.getenv('ADMIN_CLANS_SHEET_ID')
 ADMIN_TPM_SHEET_ID = os.getenv('ADMIN_TPM_SHEET_ID')
 ADMIN_LINT_SHEET_ID = os.getenv('ADMIN_LINT_SHEET_ID')
+ADMIN_TPM_DIFF_UPLOAD = True            # only upload changed rows to the tiles per member sheet if possible
 
 """ Log sheets """
 LOGS_SPREADSHEET_ID = os.getenv('LOGS_SPREADSHEET_ID')
@@ -96,6 +102,43 @@ FILES_TO_BACKUP = [
     os.path.join(CONFIG_DIR_PATH, 'Game.ini'),
     os.path.join(CONFIG_DIR_PATH, 'ServerSettings.ini')
 ]
+BACKUP_MODE = 'online'                  # 'online' uses SQLite's backup API for databases, 'copy' copies all files,
+                                        # 'dedup' stores all files deduplicated in chunks in BACKUP_STORE_PATH,
+                                        # 'compress' stores all files gzip compressed with their checksums
+BACKUP_PAGES_PER_STEP = 1024            # number of database pages copied per step of an online backup
+BACKUP_STEP_SLEEP = 0.05                # seconds to pause between the steps of an online backup
+BACKUP_STORE_PATH = os.path.join(BACKUP_DIR_PATH, 'chunks')  # chunk store shared by all deduplicated backups
+BACKUP_CHUNK_SIZE = 1024 * 1024         # size of the chunks of deduplicated backups in bytes
+BACKUP_COMPRESS_LEVEL = 1               # gzip compression level of compressed backups, 1 is fastest
+BACKUP_WORKERS = 4                      # number of files backed up in parallel
+BACKUP_WATCH_INTERVAL = 10              # seconds between two checks of the logfile in watch mode
+BACKUP_WATCH_STALL = 60                 # seconds the logfile must not advance before a backup is checked for
+
+""" Pippi money as stored in the properties table (wealth ledger) """
+# wallet properties of characters and thespians and their worth in bronze
+PIPPI_WALLET_PROPERTIES = {
+    'Pippi_WalletComponent_C.Gold': 10000,
+    'Pippi_WalletComponent_C.Silver': 100,
+    'Pippi_WalletComponent_C.Bronze': 1
+}
+# number of characters, guilds and thespians of every ledger that are checked against exiles_api's get_pippi_money
+WEALTH_LEDGER_SAMPLE = 10
+
+""" Local database used by the scripts to persist their own state between runs """
+LOCAL_DB_PATH = SAVED_DIR_PATH + "/pyScripts.db"
+CACHE_DIGEST_RECHECK = 10   # caches whose digest is slower than a rebuild time the digest again every n-th refresh
+
+""" Ruins script parameters """
+RUINS_PLAN_PATH = SAVED_DIR_PATH + "/ruins_plan.json"          # default plan file written/read by the ruins script
+RUINS_SNAPSHOT_PATH = SAVED_DIR_PATH + "/ruins_snapshot.db"    # copy of game.db the plan phase works on
+RUINS_PLAN_MAX_AGE = timedelta(hours=1)                        # plans older than this are refused by the apply phase
+RUINS_BATCH_SIZE = 1000                                        # number of rows streamed from the db at once
+
+""" Database maintenance parameters (ruins script) """
+MAINT_ADAPTIVE = True                     # False => always do a full VACUUM/REINDEX/ANALYZE/integrity_check
+MAINT_FULL_INTERVAL = timedelta(weeks=1)  # max. time between two full maintenance passes of a db
+MAINT_FULL_FREELIST_RATIO = 0.2           # ratio of free pages (freelist_count / page_count) forcing a full pass
+MAINT_INCREMENTAL_FREELIST_RATIO = 0.02   # ratio of free pages triggering an incremental_vacuum if db supports it
 
 """ Reindex script parameters """
 RI_DEST = [idx for idx in range(-1, -31, -1)]
@@ -0,0 +1,298 @@
+import pickle
+import sqlite3
+import threading
+from datetime import datetime
+from contextlib import closing
+from config import LOCAL_DB_PATH
+
+
+# the schema only has to be set up once per process
+schema_lock = threading.Lock()
+schema_ready = False
+
+
+def connect():
+    """
+    Opens a connection to the local database the scripts use to keep their own state between runs
+    """
+    global schema_ready
+    conn = sqlite3.connect(LOCAL_DB_PATH)
+    with schema_lock:
+        if not schema_ready:
+            create_schema(conn)
+            schema_ready = True
+    return conn
+
+
+def create_schema(conn):
+    """
+    Creates all tables, indexes and triggers that don't exist yet. Other processes are locked out
+    while doing so, so they don't set up the same schema at the same time
+    """
+    conn.isolation_level = None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)")
+        conn.execute("CREATE TABLE IF NOT EXISTS snapshots (name TEXT PRIMARY KEY, key TEXT, data BLOB)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS log_offsets (file_id TEXT PRIMARY KEY, path TEXT, head BLOB, offset INTEGER)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_lines (id INTEGER PRIMARY KEY, "
+            "timestamp TEXT, sender TEXT, channel TEXT, type TEXT, message TEXT, on_sheet INTEGER DEFAULT 1)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS chat_lines_timestamp ON chat_lines (timestamp)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS activity_rollups "
+            "(period TEXT, bucket TEXT, samples INTEGER, total INTEGER, peak INTEGER, PRIMARY KEY (period, bucket))"
+        )
+        if has_chat_search(conn) is None:
+            create_chat_search(conn)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.isolation_level = ''
+
+
+def has_chat_search(conn):
+    """
+    Returns True if the full-text index of the chat lines exists, False if it can't be created
+    because SQLite has been built without FTS5 and None if it hasn't been created yet
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_search'").fetchone():
+        return True
+    if not conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0]:
+        return False
+    return None
+
+
+def create_chat_search(conn):
+    """
+    Creates the full-text index of the chat messages and the triggers that keep it in sync with
+    the chat_lines table and indexes all lines that already exist
+    """
+    conn.execute(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS chat_search USING fts5(message, content='chat_lines', content_rowid='id')"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS chat_lines_insert AFTER INSERT ON chat_lines BEGIN "
+        "INSERT INTO chat_search (rowid, message) VALUES (new.id, new.message); END"
+    )
+    conn.execute(
+        "CREATE TRIGGER IF NOT EXISTS chat_lines_delete AFTER DELETE ON chat_lines BEGIN "
+        "INSERT INTO chat_search (chat_search, rowid, message) VALUES ('delete', old.id, old.message); END"
+    )
+    conn.execute("INSERT INTO chat_search (chat_search) VALUES ('rebuild')")
+
+
+def get_state(key, default=None):
+    """
+    Returns the value stored for key or default if nothing has been stored for it yet
+    """
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(key, value):
+    """
+    Stores value for key, replacing any previously stored value
+    """
+    with closing(connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+
+def load_snapshot(name, key):
+    """
+    Returns the data stored as snapshot name if it has been stored under the same key, otherwise None
+    """
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT data FROM snapshots WHERE name = ? AND key = ?", (name, key)).fetchone()
+    return pickle.loads(row[0]) if row else None
+
+
+def store_snapshot(name, key, data):
+    """
+    Stores data as snapshot name under key, replacing any previous snapshot of that name
+    """
+    blob = pickle.dumps(data)
+    with closing(connect()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO snapshots (name, key, data) VALUES (?, ?, ?)", (name, key, blob))
+
+
+def get_log_offsets():
+    """
+    Returns the stored read positions of all tailed log files as {file_id: {'path', 'head', 'offset'}}
+    """
+    with closing(connect()) as conn:
+        rows = conn.execute("SELECT file_id, path, head, offset FROM log_offsets").fetchall()
+    return {file_id: {'path': path, 'head': head, 'offset': offset} for file_id, path, head, offset in rows}
+
+
+def set_log_offsets(offsets):
+    """
+    Replaces the stored read positions of all tailed log files with offsets
+    """
+    with closing(connect()) as conn, conn:
+        conn.execute("DELETE FROM log_offsets")
+        conn.executemany(
+            "INSERT INTO log_offsets (file_id, path, head, offset) VALUES (?, ?, ?, ?)",
+            [(file_id, o['path'], o['head'], o['offset']) for file_id, o in offsets.items()]
+        )
+
+
+def to_chat_row(line, on_sheet=True):
+    """
+    Little helper function that converts a chat line as returned by ChatLogs.get_chat_info
+    (date, sender, channel, type, message) into a row of the chat_lines table
+    """
+    line = list(line) + [''] * (5 - len(line))
+    return (line[0].isoformat(' '),) + tuple(line[1:5]) + (int(on_sheet),)
+
+
+def add_chat_lines(lines, on_sheet=True):
+    """
+    Adds the given chat lines to the local chat log
+    """
+    with closing(connect()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO chat_lines (timestamp, sender, channel, type, message, on_sheet) VALUES (?, ?, ?, ?, ?, ?)",
+            [to_chat_row(line, on_sheet) for line in lines]
+        )
+
+
+def replace_sheet_chat_lines(lines):
+    """
+    Replaces all chat lines marked as being on the sheet with the given lines
+    """
+    with closing(connect()) as conn, conn:
+        conn.execute("DELETE FROM chat_lines WHERE on_sheet = 1")
+        conn.executemany(
+            "INSERT INTO chat_lines (timestamp, sender, channel, type, message, on_sheet) VALUES (?, ?, ?, ?, ?, ?)",
+            [to_chat_row(line) for line in lines]
+        )
+
+
+def count_chat_lines(after=None, until=None, on_sheet=None):
+    """
+    Returns the number of chat lines with after < timestamp <= until. Either bound can be omitted and
+    the count can be restricted to the lines that are or are not on the sheet
+    """
+    query, params = "SELECT COUNT(*) FROM chat_lines WHERE 1", []
+    if after is not None:
+        query += " AND timestamp > ?"
+        params.append(after.isoformat(' '))
+    if until is not None:
+        query += " AND timestamp <= ?"
+        params.append(until.isoformat(' '))
+    if on_sheet is not None:
+        query += " AND on_sheet = ?"
+        params.append(int(on_sheet))
+    with closing(connect()) as conn:
+        return conn.execute(query, params).fetchone()[0]
+
+
+def newest_chat_line():
+    """
+    Returns the timestamp of the newest chat line on the sheet or None if there are none
+    """
+    with closing(connect()) as conn:
+        row = conn.execute("SELECT MAX(timestamp) FROM chat_lines WHERE on_sheet = 1").fetchone()
+    return datetime.fromisoformat(row[0]) if row[0] else None
+
+
+def retire_chat_lines(num_lines):
+    """
+    Marks the num_lines oldest chat lines on the sheet as removed from the sheet
+    """
+    with closing(connect()) as conn, conn:
+        conn.execute(
+            "UPDATE chat_lines SET on_sheet = 0 WHERE id IN "
+            "(SELECT id FROM chat_lines WHERE on_sheet = 1 ORDER BY timestamp, id LIMIT ?)",
+            (num_lines,)
+        )
+
+
+def purge_chat_lines(before):
+    """
+    Deletes all chat lines that are no longer on the sheet and older than before
+    """
+    with closing(connect()) as conn, conn:
+        conn.execute("DELETE FROM chat_lines WHERE on_sheet = 0 AND timestamp < ?", (before.isoformat(' '),))
+
+
+def search_chat_lines(text=None, sender=None, channel=None, since=None, until=None, limit=100):
+    """
+    Returns the newest chat lines (date, sender, channel, type, message) matching all given filters
+    ordered from oldest to newest. text is an FTS5 query on the message, sender is matched as substring
+    and channel exactly. Without full-text index text is matched as substring of the message as well
+    """
+    with closing(connect()) as conn:
+        fts = has_chat_search(conn)
+        if text and fts:
+            query = "SELECT c.timestamp, c.sender, c.channel, c.type, c.message FROM chat_search " \
+                    "JOIN chat_lines AS c ON c.id = chat_search.rowid WHERE chat_search MATCH ?"
+            params = [text]
+        else:
+            query = "SELECT c.timestamp, c.sender, c.channel, c.type, c.message FROM chat_lines AS c WHERE 1"
+            params = []
+            if text:
+                query += " AND c.message LIKE ?"
+                params.append(f"%{text}%")
+        if sender:
+            query += " AND c.sender LIKE ?"
+            params.append(f"%{sender}%")
+        if channel:
+            query += " AND c.channel = ?"
+            params.append(channel)
+        if since:
+            query += " AND c.timestamp >= ?"
+            params.append(since.isoformat(' '))
+        if until:
+            query += " AND c.timestamp <= ?"
+            params.append(until.isoformat(' '))
+        query += " ORDER BY c.timestamp DESC LIMIT ?"
+        params.append(limit)
+        rows = conn.execute(query, params).fetchall()
+    return [(datetime.fromisoformat(row[0]),) + tuple(row[1:]) for row in reversed(rows)]
+
+
+def add_activity_rollups(samples):
+    """
+    Adds the population samples [(time_of_recording, population), ...] to the hourly, daily and hour of week
+    rollups and remembers the newest time_of_recording as state 'activity.rollup_ts' in the same transaction
+    """
+    rows = []
+    for ts, population in samples:
+        date = datetime.utcfromtimestamp(ts)
+        rows.append(('hour', date.strftime('%Y-%m-%d %H'), population))
+        rows.append(('day', date.strftime('%Y-%m-%d'), population))
+        rows.append(('hour_of_week', f"{date.weekday()} {date.hour:02d}", population))
+    if not rows:
+        return
+    with closing(connect()) as conn, conn:
+        conn.executemany(
+            "INSERT INTO activity_rollups (period, bucket, samples, total, peak) VALUES (?, ?, 1, ?3, ?3) "
+            "ON CONFLICT (period, bucket) DO UPDATE SET samples = samples + 1, total = total + excluded.total, "
+            "peak = MAX(peak, excluded.peak)",
+            rows
+        )
+        conn.execute(
+            "INSERT OR REPLACE INTO state (key, value) VALUES ('activity.rollup_ts', "
+            "MAX(?, IFNULL((SELECT value FROM state WHERE key = 'activity.rollup_ts'), 0)))",
+            (max(sample[0] for sample in samples),)
+        )
+
+
+def get_activity_rollups(period):
+    """
+    Returns the rollups of period ('hour', 'day' or 'hour_of_week') as list of (bucket, samples, average, peak)
+    ordered by bucket. Hour of week buckets are of the form 'weekday hour' with 0 being Monday
+    """
+    with closing(connect()) as conn:
+        return conn.execute(
+            "SELECT bucket, samples, CAST(total AS REAL) / samples, peak FROM activity_rollups "
+            "WHERE period = ? ORDER BY bucket", (period,)
+        ).fetchall()
@@ -0,0 +1,53 @@
+import os
+import glob
+from localdb import get_log_offsets, set_log_offsets
+
+# number of bytes at the start of a file used to recognize it again after a rename
+HEAD_SIZE = 256
+
+
+def get_file_id(stat):
+    """
+    Returns an identifier for a file that survives renames, i.e. when the server or cycle_log_files rotates it
+    """
+    return f"{stat.st_dev}:{stat.st_ino}"
+
+
+def read_new_lines(pattern, marker=None):
+    """
+    Reads all lines that have been appended to the files matching the glob pattern since the last
+    checkpoint and returns them together with the new checkpoint as (lines, offsets). Files are read
+    from oldest to newest and only lines containing marker are returned. Unknown, truncated or
+    replaced files are read from the start, incomplete last lines are left for the next call.
+    The returned offsets have to be stored with save_offsets once the lines have been processed
+    """
+    stored = get_log_offsets()
+    offsets = {}
+    lines = []
+    paths = sorted(glob.glob(pattern), key=os.path.getmtime)
+    for path in paths:
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            file_id = get_file_id(stat)
+            head = f.read(HEAD_SIZE)
+            checkpoint = stored.get(file_id)
+            offset = 0
+            # the same file if it starts with the same bytes and hasn't shrunk since it was last read
+            if checkpoint and head.startswith(checkpoint['head']) and checkpoint['offset'] <= stat.st_size:
+                offset = checkpoint['offset']
+            f.seek(offset)
+            data = f.read(stat.st_size - offset)
+        # only consume complete lines
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8', errors='replace').splitlines():
+            if marker is None or marker in line:
+                lines.append(line)
+        offsets[file_id] = {'path': path, 'head': head, 'offset': offset + end}
+    return lines, offsets
+
+
+def save_offsets(offsets):
+    """
+    Stores the checkpoint returned by read_new_lines. Files that no longer exist are forgotten
+    """
+    set_log_offsets(offsets)
@@ -0,0 +1,317 @@
+import os
+import json
+import random
+import pickle
+import hashlib
+from time import time
+from datetime import datetime
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from exiles_api import (
+    session, Buildings, Characters, Guilds, Properties, Users, TilesManager, OwnersCache, ObjectsCache
+)
+from localdb import get_state, set_state, load_snapshot, store_snapshot
+from config import SAVED_DIR_PATH, GAME_DB, PIPPI_WALLET_PROPERTIES, WEALTH_LEDGER_SAMPLE, CACHE_DIGEST_RECHECK
+
+
+def get_thrall_index(batch_size=1000):
+    """
+    Scans the properties table once and indexes all thralls and pets by their owners
+    i.e. {owner_id: [object_id1, object_id2, ...]} so they can be looked up per owner
+    without having to scan the properties table again for every single owner.
+    Properties are streamed from the db in batches of batch_size rows
+    """
+    thralls = {}
+    query = session.query(Properties).filter(Properties.name.like("%OwnerUniqueID"))
+    for property in query.yield_per(batch_size):
+        thralls.setdefault(property.owner_id, []).append(property.object_id)
+    return thralls
+
+
+def get_owner_names():
+    """
+    Loads the whole OwnersCache at once and returns it as dict {owner_id: name} for convenient lookup
+    """
+    return {id: name for id, name in session.query(OwnersCache.id, OwnersCache.name).all()}
+
+
+def get_owner_activity(batch_size=1000):
+    """
+    Determines name, last activity, number of members and tile ownership for all characters and guilds
+    with a fixed number of aggregate queries. Returns a dict of the form
+    {owner_id: {'name', 'is_guild', 'guild_id', 'last_login', 'num_members', 'has_tiles'}}
+    where last_login is the timestamp of the last login of the owner or the most recent one of its members.
+    Rows are streamed from the db in batches of batch_size rows
+    """
+    # every owner that owns at least one building or placeable
+    has_tiles = set(owner_id for owner_id, in session.query(Buildings.owner_id).distinct().yield_per(batch_size))
+    owners = {}
+    for id, name, guild_id, last_login in session.query(
+        Characters.id, Characters.name, Characters.guild_id, Characters._last_login
+    ).yield_per(batch_size):
+        owners[id] = {
+            'name': name,
+            'is_guild': False,
+            'guild_id': guild_id,
+            'last_login': last_login,
+            'num_members': 1,
+            'has_tiles': id in has_tiles
+        }
+    # guild member count and the most recent login of any of its members
+    members = {
+        guild_id: (num_members, last_login)
+        for guild_id, num_members, last_login in session.query(
+            Characters.guild_id, func.count(Characters.id), func.max(Characters._last_login)
+        ).filter(Characters.guild_id.isnot(None)).group_by(Characters.guild_id).all()
+    }
+    for id, name in session.query(Guilds.id, Guilds.name).yield_per(batch_size):
+        num_members, last_login = members.get(id, (0, None))
+        owners[id] = {
+            'name': name,
+            'is_guild': True,
+            'guild_id': None,
+            'last_login': last_login,
+            'num_members': num_members,
+            'has_tiles': id in has_tiles
+        }
+    return owners
+
+
+def get_owner_summary(inactivity):
+    """
+    Compiles members, ranks, last logins and discord names of all guilds and characters with a handful of
+    queries instead of lazy loading them owner by owner. Returns a dict of the form
+    {'guilds': {guild_id: {'name', 'members', 'num_active', 'last_to_login'}}, 'characters': {char_id: member}}
+    where every member is a dict {'id', 'name', 'guild_id', 'rank_name', 'last_login', 'disc_user', 'is_active'}
+    """
+    threshold = datetime.utcnow() - inactivity
+    users = {user.funcom_id: user for user in session.query(Users).all()}
+    characters = {}
+    for char in session.query(Characters).options(selectinload(Characters.account)).all():
+        user = users.get(char.account.funcom_id) if char.account else None
+        characters[char.id] = {
+            'id': char.id,
+            'name': char.name,
+            'guild_id': char.guild_id,
+            'rank_name': char.rank_name,
+            'last_login': char.last_login,
+            'disc_user': user.disc_user if user and user.disc_user else '',
+            'is_active': char.last_login is not None and char.last_login > threshold
+        }
+    guilds = {id: {'name': name, 'members': []} for id, name in session.query(Guilds.id, Guilds.name).all()}
+    for member in characters.values():
+        if member['guild_id'] in guilds:
+            guilds[member['guild_id']]['members'].append(member)
+    for guild in guilds.values():
+        guild['num_active'] = sum(1 for m in guild['members'] if m['is_active'])
+        logged_in = [m for m in guild['members'] if m['last_login'] is not None]
+        guild['last_to_login'] = max(logged_in, key=lambda m: m['last_login']) if logged_in else None
+    return {'guilds': guilds, 'characters': characters}
+
+
+def game_db_fingerprint():
+    """
+    Returns modification time and size of game.db and its write-ahead log (if any). Any committed
+    change to game.db changes at least one of them so they identify the state of the db
+    """
+    fingerprint = []
+    for path in (os.path.join(SAVED_DIR_PATH, GAME_DB), os.path.join(SAVED_DIR_PATH, GAME_DB + '-wal')):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint += [stat.st_mtime_ns, stat.st_size]
+    return fingerprint
+
+
+def get_snapshot(name, compute, *args, **kwargs):
+    """
+    Returns the result of compute(*args, **kwargs) from the snapshot stored for the current state of game.db
+    if there is one. Otherwise compute is called and its result stored for the next caller
+    """
+    key = json.dumps([game_db_fingerprint(), args, sorted(kwargs.items())])
+    data = load_snapshot(name, key)
+    if data is None:
+        data = compute(*args, **kwargs)
+        try:
+            store_snapshot(name, key, data)
+        # results that can't be pickled are simply not cached
+        except (pickle.PicklingError, AttributeError, TypeError):
+            pass
+    return data
+
+
+def get_tiles_by_owner(bMult, pMult, do_round=True):
+    """
+    TilesManager.get_tiles_by_owner computed at most once per state of game.db and tile multipliers
+    """
+    return get_snapshot('tiles_by_owner', TilesManager.get_tiles_by_owner, bMult, pMult, do_round=do_round)
+
+
+def get_tiles_consolidated(bMult, pMult):
+    """
+    TilesManager.get_tiles_consolidated computed at most once per state of game.db and tile multipliers
+    """
+    return get_snapshot('tiles_consolidated', TilesManager.get_tiles_consolidated, bMult, pMult)
+
+
+def decode_int_property(value):
+    """
+    Little helper function that decodes the value of an int property i.e. the little endian int32 it ends with.
+    This is how the wallet amounts appear in game.db, the layout isn't documented by Funcom which is why every
+    ledger is checked against Properties.get_pippi_money by compute_wealth_ledger
+    """
+    return int.from_bytes(value[-4:], 'little', signed=True) if value and len(value) >= 4 else 0
+
+
+def scan_wealth_ledger(batch_size=1000):
+    """
+    Scans the Pippi wallets and the ownership of all thralls in the properties table in a single pass,
+    decodes every wallet once and adds the money up per character, per guild (money of its characters)
+    and per guild's thespians (wallets of thralls owned by the guild). Returns a dict of the form
+    {'characters': {char_id: bronze}, 'guilds': {guild_id: bronze}, 'thespians': {guild_id: bronze}}
+    """
+    char_guilds = dict(session.query(Characters.id, Characters.guild_id).all())
+    guild_ids = [id for id, in session.query(Guilds.id).all()]
+    wallets, owners = {}, {}
+    query = session.query(Properties).filter(
+        Properties.name.in_(PIPPI_WALLET_PROPERTIES) | Properties.name.like("%OwnerUniqueID")
+    )
+    for property in query.yield_per(batch_size):
+        if property.name in PIPPI_WALLET_PROPERTIES:
+            bronze = decode_int_property(property.value) * PIPPI_WALLET_PROPERTIES[property.name]
+            wallets[property.object_id] = wallets.get(property.object_id, 0) + bronze
+        else:
+            owners[property.object_id] = property.owner_id
+
+    characters = {id: 0 for id in char_guilds}
+    guilds = {id: 0 for id in guild_ids}
+    thespians = {id: 0 for id in guild_ids}
+    for object_id, bronze in wallets.items():
+        if object_id in characters:
+            characters[object_id] += bronze
+            if char_guilds[object_id] is not None:
+                guilds[char_guilds[object_id]] = guilds.get(char_guilds[object_id], 0) + bronze
+        elif owners.get(object_id) in thespians:
+            thespians[owners[object_id]] += bronze
+    return {'characters': characters, 'guilds': guilds, 'thespians': thespians}
+
+
+def get_pippi_money(kind, id):
+    """
+    Little helper function that returns the money of one entry of the wealth ledger from Properties.get_pippi_money
+    """
+    if kind == 'characters':
+        return Properties.get_pippi_money(character_id=id, as_number=True)
+    elif kind == 'guilds':
+        return Properties.get_pippi_money(guild_id=id, with_thespians=False, as_number=True)
+    return Properties.get_pippi_money(guild_id=id, with_chars=False, as_number=True)
+
+
+def verify_wealth_ledger(ledger, sample_size=WEALTH_LEDGER_SAMPLE):
+    """
+    Compares up to sample_size random characters, guilds and thespians of the ledger with Properties.get_pippi_money
+    and returns the mismatches as [(kind, id, ledger_bronze, pippi_bronze), ...]
+    """
+    mismatches = []
+    for kind, entries in ledger.items():
+        for id in random.sample(sorted(entries), min(sample_size, len(entries))):
+            bronze = get_pippi_money(kind, id)
+            if entries[id] != bronze:
+                mismatches.append((kind, id, entries[id], bronze))
+    return mismatches
+
+
+def compute_wealth_ledger(batch_size=1000):
+    """
+    Computes the wealth ledger with scan_wealth_ledger and verifies it with a sample of Properties.get_pippi_money.
+    If they disagree, the ledger is computed owner by owner with Properties.get_pippi_money instead. Returns the
+    ledger together with the mismatches found as {'characters': ..., 'guilds': ..., 'thespians': ..., 'mismatches'}
+    """
+    ledger = scan_wealth_ledger(batch_size)
+    mismatches = verify_wealth_ledger(ledger)
+    if mismatches:
+        ledger = {kind: {id: get_pippi_money(kind, id) for id in entries} for kind, entries in ledger.items()}
+    ledger['mismatches'] = mismatches
+    return ledger
+
+
+def get_wealth_ledger():
+    """
+    The wealth ledger (see compute_wealth_ledger) computed at most once per state of game.db
+    """
+    return get_snapshot('wealth_ledger', compute_wealth_ledger)
+
+
+def get_owners_digest(batch_size=1000):
+    """
+    Hashes ids, names and guilds of all characters and guilds i.e. everything OwnersCache is built from
+    """
+    digest = hashlib.sha1()
+    for query in (
+        session.query(Characters.id, Characters.name, Characters.guild_id).order_by(Characters.id),
+        session.query(Guilds.id, Guilds.name).order_by(Guilds.id)
+    ):
+        for row in query.yield_per(batch_size):
+            digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+def get_objects_digest(batch_size=1000):
+    """
+    Hashes the objects per owner and all existing owners i.e. everything ObjectsCache is built from
+    """
+    digest = hashlib.sha1()
+    query = session.query(
+        Buildings.owner_id, func.count(Buildings.object_id), func.sum(Buildings.object_id)
+    ).group_by(Buildings.owner_id).order_by(Buildings.owner_id)
+    for row in query.yield_per(batch_size):
+        digest.update(repr(tuple(row)).encode())
+    for query in (session.query(Characters.id).order_by(Characters.id), session.query(Guilds.id).order_by(Guilds.id)):
+        for row in query.yield_per(batch_size):
+            digest.update(repr(tuple(row)).encode())
+    return digest.hexdigest()
+
+
+def refresh_cache(name, cache, get_digest, ruins_clan_id):
+    """
+    Calls cache.update(ruins_clan_id) only if the rows the cache is built from have changed since its last refresh.
+    If game.db hasn't changed at all, not even the digest of those rows has to be computed. Any change to those
+    rows still rebuilds the whole cache. Both the digest and the rebuild are timed and as long as the digest takes
+    longer than a rebuild, the cache is simply rebuilt, timing the digest again every CACHE_DIGEST_RECHECK refreshes.
+    Returns True if the cache has been updated and False otherwise
+    """
+    fingerprint = json.dumps(game_db_fingerprint())
+    if get_state(f"caches.{name}.fingerprint") == fingerprint:
+        return False
+    digest_time = get_state(f"caches.{name}.digest_time")
+    update_time = get_state(f"caches.{name}.update_time")
+    skipped = get_state(f"caches.{name}.digests_skipped", 0)
+    digest = None
+    if digest_time is None or update_time is None or digest_time < update_time or skipped >= CACHE_DIGEST_RECHECK:
+        start = time()
+        digest = get_digest()
+        set_state(f"caches.{name}.digest_time", time() - start)
+        set_state(f"caches.{name}.digests_skipped", 0)
+    else:
+        set_state(f"caches.{name}.digests_skipped", skipped + 1)
+    updated = digest is None or get_state(f"caches.{name}.digest") != digest
+    if updated:
+        start = time()
+        cache.update(ruins_clan_id)
+        set_state(f"caches.{name}.update_time", time() - start)
+        set_state(f"caches.{name}.digest", digest)
+    set_state(f"caches.{name}.fingerprint", fingerprint)
+    return updated
+
+
+def refresh_owners_cache(ruins_clan_id):
+    """
+    OwnersCache.update(ruins_clan_id) skipped if none of its inputs have changed, see refresh_cache
+    """
+    return refresh_cache('owners', OwnersCache, get_owners_digest, ruins_clan_id)
+
+
+def refresh_objects_cache(ruins_clan_id):
+    """
+    ObjectsCache.update(ruins_clan_id) skipped if none of its inputs have changed, see refresh_cache
+    """
+    return refresh_cache('objects', ObjectsCache, get_objects_digest, ruins_clan_id)
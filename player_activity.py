@@ -1,12 +1,13 @@
 import sys
 import logging
-from sqlalchemy import desc
-from datetime import datetime
+from datetime import datetime, timezone
 from exiles_api import session, ServerPopulationRecordings as PopRecs
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from localdb import get_state, add_activity_rollups
 from config import (
-    PLAYER_SPREADSHEET_ID, PLAYER_ACTIVITY_SHEET_ID, ACTIVITY_HOLD_BACK, MAX_POP, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
+    PLAYER_SPREADSHEET_ID, PLAYER_ACTIVITY_SHEET_ID, ACTIVITY_HOLD_BACK, MAX_POP, ACTIVITY_ROLLUPS,
+    LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
 )
 
 # catch unhandled exceptions
@@ -48,17 +49,25 @@ dates = [r[0] for r in sheets.read('Activity Statistics!A2:A' + str(lastRow), is
 newestDate = dates[-1] if len(dates) > 0 and dates[-1] > ageThreshold else ageThreshold
 
 logger.debug("Reading new data from game.db.")
-values = []
-# read all the timestamps and population values from ServerPopulationRecordings starting with the newest
-for record in session.query(PopRecs).order_by(desc(PopRecs.time_of_recording)).all():
-    # while the newest date found in the db is newer than the newest date read from the sheet add it to values
-    checkDate = datetime.utcfromtimestamp(record.time_of_recording)
-    if checkDate > newestDate:
-        values.insert(0, [checkDate.strftime("%Y-%m-%d %H:%M:%S"), int(record.population * MAX_POP)])
-    else:
-        break
+# only the recordings newer than the newest date on the sheet are read, ordered from oldest to newest.
+# If rollups are enabled, the recordings not yet rolled up have to be read as well
+newestTs = newestDate.replace(tzinfo=timezone.utc).timestamp()
+rollupTs = get_state('activity.rollup_ts', 0) if ACTIVITY_ROLLUPS else newestTs
+query = session.query(PopRecs.time_of_recording, PopRecs.population)
+records = query.filter(PopRecs.time_of_recording > min(newestTs, rollupTs)).order_by(PopRecs.time_of_recording).all()
 session.close()
 
+values = []
+for time_of_recording, population in records:
+    if time_of_recording > newestTs:
+        checkDate = datetime.utcfromtimestamp(time_of_recording)
+        values.append([checkDate.strftime("%Y-%m-%d %H:%M:%S"), int(population * MAX_POP)])
+
+if ACTIVITY_ROLLUPS:
+    logger.debug("Updating activity rollups.")
+    samples = [(ts, int(population * MAX_POP)) for ts, population in records if ts > rollupTs]
+    add_activity_rollups(samples)
+
 """ Write new data to spreadsheet """
 
 logger.debug("Updating activity sheet with new lines.")
@@ -1,11 +1,14 @@
 import sys
 import logging
 from datetime import datetime, timedelta
-from exiles_api import db_date, OwnersCache, ObjectsCache, Stats
+from statistics import mean, median
+from exiles_api import db_date, session, Characters, Stats
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from lookups import get_wealth_ledger, refresh_owners_cache, refresh_objects_cache
+from localdb import count_chat_lines
 from config import (
-    RUINS_CLAN_ID, LOGS_SPREADSHEET_ID, LOGS_CHAT_SHEET_ID, INACTIVITY, PLAYER_SPREADSHEET_ID,
+    RUINS_CLAN_ID, INACTIVITY, PLAYER_SPREADSHEET_ID,
     PLAYER_STATISTICS_SHEET_ID, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE
 )
 
@@ -31,9 +34,11 @@ logger.info("Updating statistics sheet...")
 
 # update the caches
 logger.debug("Updating OwnersCache.")
-OwnersCache.update(RUINS_CLAN_ID)
+if not refresh_owners_cache(RUINS_CLAN_ID):
+    logger.debug("OwnersCache is up to date.")
 logger.debug("Updating ObjectsCache.")
-ObjectsCache.update(RUINS_CLAN_ID)
+if not refresh_objects_cache(RUINS_CLAN_ID):
+    logger.debug("ObjectsCache is up to date.")
 
 # estimate db age by reading the last_login date of the first character in the characters table
 if dbAge := db_date():
@@ -44,21 +49,10 @@ else:
     logger.info(f"Found no characters in db!\nRequired time: {execTimeStr} sec.")
     sys.exit(0)
 
-# read the number of chatlines
-logger.debug("Read number of chatlines from chatlog sheet.")
-sheets = Spreadsheet(LOGS_SPREADSHEET_ID, activeSheetId=LOGS_CHAT_SHEET_ID)
-lastRow = sheets.get_properties()["gridProperties"]["rowCount"] - 1
-dates = [r[0] for r in sheets.read('Chat Log!A3:A' + str(lastRow), is_ordinal=True)] if lastRow >= 2 else []
-
-num_lines = 0
+# count the chatlines of the last 24 hours in the local chat log kept by admin_process_chatlogs
+logger.debug("Count chatlines of the last 24 hours.")
 threshold24h = dbAge - timedelta(hours=24)
-for idx in range(len(dates)-1, 1, -1):
-    if dates[idx] > dbAge:
-        continue
-    if dates[idx] > threshold24h:
-        num_lines += 1
-    else:
-        break
+num_lines = count_chat_lines(after=threshold24h, until=dbAge)
 
 
 def divby10k(num):
@@ -76,6 +70,16 @@ def divby10k(num):
 # Get the statistics
 logger.debug("Compile statistics from game.db.")
 stats = Stats.get_tile_statistics(INACTIVITY)
+# the wealth statistics are taken from the wealth ledger shared with the admin sheets
+logger.debug("Compile wealth statistics from the wealth ledger.")
+ledger = get_wealth_ledger()
+if ledger['mismatches']:
+    logger.error(f"Wealth ledger disagreed with get_pippi_money and was computed per owner: {ledger['mismatches']}")
+# like the other statistics, activity is relative to the date of the db
+active_ts = int((dbAge - INACTIVITY).timestamp())
+active_chars = session.query(Characters.id).filter(Characters._last_login > active_ts).all()
+active_wealth = [ledger['characters'].get(id, 0) for id, in active_chars]
+total_wealth = sum(ledger['characters'].values()) + sum(ledger['thespians'].values())
 value = []
 value.append(dbAge.strftime("%d/%m/%Y %H:%M:%S"))
 value.append(stats['numTiles'])
@@ -90,9 +94,9 @@ value.append(stats['numActiveChars'])
 value.append(stats['numInactiveChars'])
 value.append(stats['numLogins'])
 value.append(num_lines)
-value.append(divby10k(stats['totalWealth']))
-value.append(round(divby10k(stats['meanActiveCharsWealth']), 4))
-value.append(divby10k(stats['medianActiveCharsWealth']))
+value.append(divby10k(total_wealth))
+value.append(round(divby10k(mean(active_wealth) if active_wealth else 0), 4))
+value.append(divby10k(median(active_wealth) if active_wealth else 0))
 value.append(stats['numRuins'])
 values = [value]
 
@@ -2,9 +2,10 @@ import sys
 import logging
 from datetime import datetime
 from operator import itemgetter
-from exiles_api import db_date, OwnersCache, ObjectsCache, TilesManager, MembersManager
+from exiles_api import db_date, MembersManager
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from lookups import get_tiles_by_owner, refresh_owners_cache, refresh_objects_cache
 from config import (
     RUINS_CLAN_ID, PLAYER_SPREADSHEET_ID, PLAYER_TPM_SHEET_ID, INACTIVITY, BUILDING_TILE_MULT, PLACEBALE_TILE_MULT,
     OWNER_WHITELIST, HIDE_WHITELISTED_OWNERS, ALLOWANCE_INCLUDES_INACTIVES, ALLOWANCE_BASE, ALLOWANCE_CLAN,
@@ -33,9 +34,11 @@ logger.info("Updating tiles per member sheet...")
 
 # update the caches
 logger.debug("Updating OwnersCache.")
-OwnersCache.update(RUINS_CLAN_ID)
+if not refresh_owners_cache(RUINS_CLAN_ID):
+    logger.debug("OwnersCache is up to date.")
 logger.debug("Updating ObjectsCache.")
-ObjectsCache.update(RUINS_CLAN_ID)
+if not refresh_objects_cache(RUINS_CLAN_ID):
+    logger.debug("ObjectsCache is up to date.")
 
 # estimate db age by reading the last_login date of the first character in the characters table
 if dbAge := db_date():
@@ -54,7 +57,7 @@ date_str = now.strftime("%d-%b-%Y %H:%M UTC")
 values = []
 
 logger.debug("Gather tiles statistics.")
-building_pieces, placeables = TilesManager.get_tiles_by_owner(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT, do_round=False)
+building_pieces, placeables = get_tiles_by_owner(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT, do_round=False)
 logger.debug("Gather member statistics.")
 members = MembersManager.get_members(INACTIVITY)
 
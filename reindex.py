@@ -4,6 +4,7 @@ from datetime import datetime
 from config import LOG_LEVEL, RI_DEST, RI_SOURCE, LOG_LEVEL_STDOUT
 from logger import get_logger
 from exiles_api import engines, session, Properties
+from lookups import get_thrall_index
 
 # catch unhandled exceptions
 logger = get_logger('reindex.log', LOG_LEVEL)
@@ -37,6 +38,10 @@ existing_ids = (
 owner_ids = "SELECT DISTINCT id AS id FROM characters UNION	SELECT DISTINCT guildId AS id FROM guilds"
 source_idx = 0
 
+# index all thralls by their owners once instead of scanning the properties table for every source id
+logger.debug("Index thralls by their owners.")
+thralls = get_thrall_index()
+
 logger.debug("Create connection to game.db.")
 with engines["gamedb"].begin() as conn:
     for dest_id in dest:
@@ -80,10 +85,13 @@ with engines["gamedb"].begin() as conn:
 
             # give thralls and pets (if any) belonging to source_id to the dest_id instead
             logger.debug(f"Give thralls belonging to {source_id} to {dest_id}.")
-            object_ids = Properties.get_thrall_object_ids(owner_id=source_id)
+            object_ids = thralls.pop(source_id, [])
             if object_ids:
                 logger.debug(f"Found thralls with object_ids {str(object_ids)} belonging to {source_id}.")
             Properties.give_thrall(object_ids, dest_id, autocommit=False)
+            # keep the index in line with the changes so later source ids see the new owner
+            if object_ids:
+                thralls.setdefault(dest_id, []).extend(object_ids)
 
 # try to commit all changes
 logger.debug("Commit changes.")
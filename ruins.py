@@ -1,17 +1,30 @@
+import os
+import re
 import sys
+import json
 import random
+import sqlite3
 import logging
-from time import time
+import psutil
+import argparse
+import subprocess
+import config
+from time import time, sleep
+from pathlib import Path
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from sqlalchemy import case, text
+from sqlalchemy.orm import selectinload
 from logger import get_logger
 from config import (
     LOG_LEVEL_STDOUT, LOG_LEVEL_FILE, RUINS_CLAN_ID, INACTIVITY, LONG_INACTIVE, EVENT_LOG_HOLD_BACK,
-    OBJECT_LIMITS, OWNER_WHITELIST, ALLOWANCE_INCLUDES_INACTIVES, PURGE
-)
-from exiles_api import (
-    StaticBuildables, session, engines, Guilds, GameEvents, ActorPosition, Buildings, Tiles, Characters,
-    DeleteChars, OwnersCache, ObjectsCache, Properties, Thralls, BuildableHealth
+    OBJECT_LIMITS, OWNER_WHITELIST, ALLOWANCE_INCLUDES_INACTIVES, PURGE, MAINT_ADAPTIVE, MAINT_FULL_INTERVAL,
+    MAINT_FULL_FREELIST_RATIO, MAINT_INCREMENTAL_FREELIST_RATIO, SAVED_DIR_PATH, GAME_DB, RUINS_PLAN_PATH,
+    RUINS_SNAPSHOT_PATH, RUINS_PLAN_MAX_AGE, EVENT_LOG_CULL_BATCH, RUINS_BATCH_SIZE, BACKUP_PAGES_PER_STEP,
+    BACKUP_STEP_SLEEP
 )
+from localdb import get_state, set_state
 
 # catch unhandled exceptions
 logger = get_logger('ruins.log', log_level_stdout=LOG_LEVEL_STDOUT, log_level_file=LOG_LEVEL_FILE)
@@ -27,21 +40,55 @@ def handle_exception(exc_type, exc_value, exc_traceback):
 
 sys.excepthook = handle_exception
 
+# maximum number of ids passed to a single IN clause (SQLite limits the number of bound variables to 999)
+CHUNK_SIZE = 500
+
+
+def chunks(seq, size):
+    """
+    Little helper function that splits a sequence into lists of at most size elements
+    """
+    seq = list(seq)
+    for idx in range(0, len(seq), size):
+        yield seq[idx:idx + size]
+
+
+def peak_memory():
+    """
+    Little helper function that returns the peak resident memory of the running process in MiB
+    """
+    memory_info = psutil.Process().memory_info()
+    # psutil only knows the peak on Windows, elsewhere the resource module has to be asked
+    if hasattr(memory_info, 'peak_wset'):
+        return memory_info.peak_wset / 2**20
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is given in bytes on macOS and in KiB everywhere else
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+def pause(status, remaining, total):
+    """
+    Little helper function passed as progress callback to the online backup API to pause between its steps
+    """
+    if remaining:
+        sleep(BACKUP_STEP_SLEEP)
+
+
+# the plan phase decides on all changes against a snapshot of game.db and writes them into a plan file
+# the apply phase executes such a plan in a single short transaction against the live game.db
+parser = argparse.ArgumentParser(description="Removes, renames, reassigns and damages ruins in game.db.")
+parser.add_argument('phase', nargs='?', choices=('plan', 'apply', 'all'), default='all',
+                    help="phase to run, 'all' runs the plan phase followed by the apply phase (default)")
+parser.add_argument('--plan', default=RUINS_PLAN_PATH, help="path of the plan file to write or read")
+args = parser.parse_args()
+
 # save current time
 start_time = time()
 now = datetime.utcnow()
 if LOG_LEVEL_STDOUT > logging.INFO:
-    print("Executing ruins script...")
-logger.info("Executing ruins script...")
-
-# make sure a ruins clan exists
-ruins_clan = session.query(Guilds).get(RUINS_CLAN_ID)
-if not ruins_clan:
-    ruins_clan = Guilds(id=RUINS_CLAN_ID, name='Ruins')
-    session.add(ruins_clan)
-
-# seed the random number generator
-random.seed()
+    print(f"Executing ruins script ({args.phase})...")
+logger.info(f"Executing ruins script ({args.phase})...")
 
 # store some timestamps required for following operations
 now_ts = int(now.timestamp())
@@ -49,219 +96,512 @@ ia_ts = int((now - INACTIVITY).timestamp())
 lia_ts = int((now - LONG_INACTIVE).timestamp())
 el_ts = int((now - EVENT_LOG_HOLD_BACK).timestamp())
 
-""" Cull the event log """
-logger.debug("Culling the events log.")
-session.query(GameEvents).filter(GameEvents.world_time <= el_ts).delete()
+if args.phase == 'all':
+    # exiles_api can only be bound to one game.db per process so the plan phase runs in a process of its own
+    if subprocess.run([sys.executable, __file__, 'plan', '--plan', args.plan]).returncode != 0:
+        logger.error("Plan phase failed! No changes have been applied.")
+        sys.exit(1)
+elif args.phase == 'plan':
+    # take a consistent copy of game.db with the online backup API and point exiles_api at it before importing it
+    logger.debug("Taking snapshot of game.db.")
+    # game.db is opened read-only and copied in steps so the server isn't locked out during the whole copy
+    game_db_uri = Path(SAVED_DIR_PATH, GAME_DB).resolve().as_uri() + '?mode=ro'
+    with closing(sqlite3.connect(game_db_uri, uri=True)) as source:
+        with closing(sqlite3.connect(RUINS_SNAPSHOT_PATH)) as snapshot:
+            source.backup(snapshot, pages=BACKUP_PAGES_PER_STEP, progress=pause)
+    config.GAME_DB_URI = "sqlite:///" + RUINS_SNAPSHOT_PATH
+
+from exiles_api import (  # noqa: E402 exiles_api must not be imported before the snapshot has been set up
+    StaticBuildables, session, engines, Guilds, GameEvents, ActorPosition, Buildings, Tiles, Characters,
+    DeleteChars, ObjectsCache, Thralls, BuildableHealth, Users
+)
+from lookups import (  # noqa: E402
+    get_thrall_index, get_owner_activity, get_owner_names, refresh_owners_cache, refresh_objects_cache
+)
+
+
+def like_to_regex(pattern):
+    """
+    Little helper function that translates the pattern of a "LIKE '%pattern%'" filter
+    into an equivalent regular expression i.e. '_' matches any single character
+    """
+    return ''.join('.' if c == '_' else '.*' if c == '%' else re.escape(c) for c in pattern)
 
-""" Delete some blacklisted items placed in the world """
-logger.debug("Deleting blacklisted items.")
-for limit in OBJECT_LIMITS:
-    # non-existing per_member value is assumed to be 0
-    per_member = limit['pm'] if 'pm' in limit else 0
-    # construct the filter consisting of the link between the two tables and the 'like' filters over the classes
+
+def is_inactive(owner):
+    """
+    Little helper function that checks if the last login of an owner (or any of its members) is too long ago
+    """
+    return owner['last_login'] is None or owner['last_login'] <= ia_ts
+
+
+def plan():
+    """
+    Decides on all changes to game.db without changing it and returns them as a dict that can be serialized as json
+    """
+    # the activity thresholds are kept so apply can check the decisions against the live game.db again
+    changes = {'created': now_ts, 'event_log_ts': el_ts, 'ia_ts': ia_ts, 'lia_ts': lia_ts}
+
+    # seed the random number generator
+    random.seed()
+
+    """ Delete some blacklisted items placed in the world """
+    logger.debug("Deciding on blacklisted items to delete.")
+    # precompile one case insensitive matcher per limit (like SQLite LIKE) covering all the classes listed for it
+    matchers = [
+        re.compile('|'.join(like_to_regex(class_name) for class_name in limit['obj']), re.IGNORECASE)
+        for limit in OBJECT_LIMITS
+    ]
+    # many objects share the same class so the limits each class falls under only need to be determined once
+    limits_by_class = {}
+    # consolidate all objects per limit and owner i.e. {limit_index: {owner_id: [object1, object2, object3...]}}
+    objects_by_limit = {idx: {} for idx in range(len(OBJECT_LIMITS))}
+    # scan all objects that are not whitelisted once and classify them against all limits at the same time
     filter_link = (ActorPosition.id == Buildings.object_id) & Buildings.owner_id.notin_(OWNER_WHITELIST)
-    filter_class = None
-    for class_name in limit['obj']:
-        if filter_class is None:
-            filter_class = ActorPosition.class_.like(f"%{class_name}%")
-        else:
-            filter_class = filter_class | ActorPosition.class_.like(f"%{class_name}%")
-    # consolidate all objects belonging to a given owner i.e. {owner_id: [object1, object2, object3...]}
+    objects_query = session.query(
+        ActorPosition.id, ActorPosition.class_, ActorPosition.x, ActorPosition.y, ActorPosition.z, Buildings.owner_id
+    ).filter(filter_link)
+    for obj in objects_query.yield_per(RUINS_BATCH_SIZE):
+        if obj.class_ not in limits_by_class:
+            limits_by_class[obj.class_] = tuple(idx for idx, m in enumerate(matchers) if m.search(obj.class_ or ''))
+        for idx in limits_by_class[obj.class_]:
+            objects_by_limit[idx].setdefault(obj.owner_id, []).append(obj)
+
+    # only owners that have more objects than the flat maximum can possibly exceed their allowance
+    candidates = set()
+    for idx, objects_by_owner in objects_by_limit.items():
+        candidates.update(o for o, objects in objects_by_owner.items() if len(objects) > OBJECT_LIMITS[idx]['max'])
+    # load those owners in one go. Owners that can't be found in either table are skipped
     owners = {}
-    for id, building in session.query(ActorPosition, Buildings).filter(filter_link & (filter_class)).all():
-        if building.owner is None:
+    for chunk in chunks(candidates, CHUNK_SIZE):
+        owners.update({g.id: g for g in session.query(Guilds).filter(Guilds.id.in_(chunk)).all()})
+        owners.update({c.id: c for c in session.query(Characters).filter(Characters.id.in_(chunk)).all()})
+
+    # for each limit and owner check if number of objects found exceeds the allowance. The limits are processed
+    # in order and objects picked for removal by an earlier limit no longer count against the later ones
+    picked_object_ids = []
+    picked = set()
+    for idx, limit in enumerate(OBJECT_LIMITS):
+        # non-existing per_member value is assumed to be 0
+        per_member = limit['pm'] if 'pm' in limit else 0
+        for owner_id, objects in objects_by_limit[idx].items():
+            owner = owners.get(owner_id)
+            if owner is None:
+                continue
+            objects = [obj for obj in objects if obj.id not in picked]
+            if ALLOWANCE_INCLUDES_INACTIVES:
+                num_members = len(owner.members) if owner.is_guild else 1
+            else:
+                num_members = len(owner.active_members(INACTIVITY)) if owner.is_guild else 1
+            diff = len(objects) - limit['max'] - num_members * per_member
+            # if allowance has been exceeded
+            if diff > 0:
+                logger.info(f"Deleting the following objects from {owner.name} ({owner.id}):")
+                # pick diff amount of objects from the objects list and mark them for removal
+                for obj in random.sample(objects, diff):
+                    picked_object_ids.append(obj.id)
+                    picked.add(obj.id)
+                    tp = f"TeleportPlayer {round(obj.x)} {round(obj.y)} {round(obj.z)}"
+                    logger.info(f"{obj.class_[obj.class_.rfind('.')+1:]} ({obj.id}): {tp}")
+    changes['remove_objects'] = picked_object_ids
+
+    """ Delete old characters from the db and clean up behind them """
+    logger.debug("Deciding on old characters to delete.")
+    char_ids = set()
+    player_ids = {}
+    # get all characters who logged in before a configured time together with their accounts
+    filter = (Characters._last_login <= lia_ts) & Characters.id.notin_(OWNER_WHITELIST)
+    deleted_chars = session.query(Characters).options(selectinload(Characters.account)).filter(filter).all()
+    # prefetch the users of all those characters keyed by their funcom_id
+    funcom_ids = set(char.account.funcom_id for char in deleted_chars if char.account)
+    users = {}
+    for chunk in chunks(funcom_ids, CHUNK_SIZE):
+        users.update({user.funcom_id: user for user in session.query(Users).filter(Users.funcom_id.in_(chunk)).all()})
+    for char in deleted_chars:
+        funcom_id = char.account.funcom_id if char.account else None
+        user = users.get(funcom_id)
+        if user:
+            player = f"{user.disc_user} ({user.disc_id}) with FuncomID {user.funcom_id} and PlayerID {char.player_id}"
+        else:
+            player = f" with FuncomID {funcom_id} and PlayerID {char.player_id}"
+        logger.info(f"Deleting {char.name} ({char.id}) belonging to player {player}.")
+        player_ids.update({char.player_id: char.name})
+        char_ids.add(char.id)
+    changes['delete_chars'] = sorted(char_ids)
+    changes['deleted_players'] = list(player_ids.items())
+
+    """ Rename applicable characters/guilds to ruins or rename them back to their original names"""
+    # update the OwnersCache table and load it into a dict for convenient lookup
+    logger.debug("Deciding on characters and guilds to rename from and to 'Ruins'.")
+    refresh_owners_cache(RUINS_CLAN_ID)
+    ownerscache = get_owner_names()
+
+    # determine activity, members and tiles of all owners at once and decide on the renames based on that
+    owners = {id: owner for id, owner in get_owner_activity(RUINS_BATCH_SIZE).items() if id not in char_ids}
+    rename_chars, rename_guilds, delete_guilds = {}, {}, []
+    for id, owner in sorted(owners.items()):
+        if not owner['is_guild']:
+            # go through all chars named 'Ruins' that are no longer inactive and rename them to their original name
+            if not is_inactive(owner):
+                if owner['name'] == 'Ruins' and id in ownerscache:
+                    logger.info(f"Renaming char with id {id} back from 'Ruins' to '{ownerscache[id]}'.")
+                    rename_chars[id] = ownerscache[id]
+            # go through all characters that are not whitelisted, not in a guild and inactive
+            elif id not in OWNER_WHITELIST and owner['guild_id'] is None:
+                # if char is named Ruins but has no buildings left, rename back to original name in case they return
+                if owner['name'] == 'Ruins' and not owner['has_tiles'] and id in ownerscache:
+                    logger.info(f"Renaming char with id {id} back from 'Ruins' to '{ownerscache[id]}'.")
+                    rename_chars[id] = ownerscache[id]
+                # if char is not named Ruins and still has buildings left, rename to ruins
+                elif owner['name'] != 'Ruins' and owner['has_tiles']:
+                    logger.info(f"Renaming char with id {id} from '{ownerscache.get(id, owner['name'])}' to 'Ruins'.")
+                    rename_chars[id] = 'Ruins'
+        elif id == RUINS_CLAN_ID:
+            continue
+        # go through all guilds named 'Ruins' that are no longer inactive and rename them to their original name
+        elif not is_inactive(owner):
+            if owner['name'] == 'Ruins' and id in ownerscache:
+                logger.info(f"Renaming guild with id {id} back from 'Ruins' to '{ownerscache[id]}'.")
+                rename_guilds[id] = ownerscache[id]
+        # go through all inactive guilds that are not whitelisted
+        elif id not in OWNER_WHITELIST:
+            # if guild has no members, delete it. This will place it's buidlings on the ObjectsCache when next updated
+            if owner['num_members'] == 0:
+                delete_guilds.append(id)
+            # if guild is named Ruins but has no buildings left, rename back to original name in case owner(s) return
+            elif owner['name'] == 'Ruins' and not owner['has_tiles'] and id in ownerscache:
+                logger.info(f"Renaming guild with id {id} back from 'Ruins' to '{ownerscache[id]}'.")
+                rename_guilds[id] = ownerscache[id]
+            # if guild is not named Ruins and still has buildings left, rename to ruins
+            elif owner['name'] != 'Ruins' and owner['has_tiles']:
+                logger.info(f"Renaming guild with id {id} from '{ownerscache.get(id, owner['name'])}' to 'Ruins'.")
+                rename_guilds[id] = 'Ruins'
+    changes['rename_chars'] = list(rename_chars.items())
+    changes['rename_guilds'] = list(rename_guilds.items())
+    changes['delete_guilds'] = delete_guilds
+
+    """ move all owner_id 0 objects to the dedicated ruins clan """
+    stat_builds = session.query(StaticBuildables.id).scalar_subquery()
+    filter = Buildings.object_id.notin_(stat_builds) & (Buildings.owner_id == 0)
+    changes['reassign_zero'] = [object_id for object_id, in session.query(Buildings.object_id).filter(filter).all()]
+    if len(changes['reassign_zero']) > 0:
+        logger.info(f"Moving owner_id 0 objects to dedicated Ruins clan: {str(changes['reassign_zero'])}.")
+
+    """ move all ownerless objects to the dedicated ruins clan """
+    logger.debug("Deciding on ownerless objects to move to dedicated ruins clan.")
+    # update the ObjectsCache table and load it into a dict for convenient lookup
+    refresh_objects_cache(RUINS_CLAN_ID)
+    objectscache_query = session.query(ObjectsCache.id, ObjectsCache._timestamp)
+    objectscache = {id: ts for id, ts in objectscache_query.yield_per(RUINS_BATCH_SIZE)}
+
+    # add all object_ids that belong to the dedicated ruins clan into a set for an easy check
+    ruins_clan_query = session.query(Buildings.object_id).filter_by(owner_id=RUINS_CLAN_ID)
+    ruins_clan = set(r for r, in ruins_clan_query.yield_per(RUINS_BATCH_SIZE))
+
+    # if ownerless object is not yet in the ruins clan, move it there
+    # since ObjectsCache was just updated, it should only contain existing objects
+    changes['reassign_ownerless'] = [object_id for object_id in objectscache if object_id not in ruins_clan]
+    if len(changes['reassign_ownerless']) > 0:
+        logger.info(f"Moving no owner objects to dedicated Ruins clan: {str(changes['reassign_ownerless'])}.")
+
+    """ damage or remove buildins belonging to 'Ruins' owners """
+    logger.debug("Deciding on damage to and removal of buildings belonging to the dedicated ruins clan.")
+    # index all thralls by their owners so they can be removed alongside their owners buildings
+    thralls = get_thrall_index(RUINS_BATCH_SIZE)
+
+    # owners named 'Ruins' once the renames above have been applied
+    ruins_owners = {id for id, owner in owners.items() if owner['name'] == 'Ruins'} - set(delete_guilds)
+    for id, name in list(rename_chars.items()) + list(rename_guilds.items()):
+        if name == 'Ruins':
+            ruins_owners.add(id)
+        else:
+            ruins_owners.discard(id)
+    ruins_owners.add(RUINS_CLAN_ID)
+    # objects that are going to be moved to the ruins clan or removed anyway
+    reassigned = set(changes['reassign_zero']) | set(changes['reassign_ownerless'])
+    removed_objects = set(changes['remove_objects'])
+
+    # collect the object_ids per damage value so that each damage value only requires a single update
+    damage = {}
+    removed, killed = [], {}
+    ruins_query = session.query(Buildings.object_id, Buildings.owner_id).filter(
+        Buildings.owner_id.notin_(OWNER_WHITELIST)
+    )
+    for object_id, owner_id in ruins_query.yield_per(RUINS_BATCH_SIZE):
+        if object_id in removed_objects:
             continue
-        elif building.owner not in owners:
-            owners[building.owner] = [id]
+        if object_id in reassigned:
+            owner_id = RUINS_CLAN_ID
+        # buildings of characters deleted in this run are handled right away as well
+        elif owner_id not in ruins_owners and owner_id not in char_ids:
+            continue
+        # if building has no owner, the time since last login needs to be determined via objectscache timestamp
+        if object_id in objectscache:
+            time_since_inactive = timedelta(seconds=now_ts-objectscache[object_id])
+        # If owner is being deleted for inactivity assume that their buildings should also be removed
+        elif owner_id in char_ids:
+            time_since_inactive = INACTIVITY + PURGE
+        # otherwise use the timestamp of the last login
+        elif owner_id in owners and owners[owner_id]['last_login'] is not None:
+            time_since_inactive = timedelta(seconds=now_ts-owners[owner_id]['last_login']) - INACTIVITY
+        # should never get here but catch it anyway
         else:
-            owners[building.owner] += [id]
-    # for each owner check if number of objects found exceeds the allowance
-    for owner, objects in owners.items():
-        if ALLOWANCE_INCLUDES_INACTIVES:
-            num_members = len(owner.members) if owner.is_guild else 1
+            logger.warning(f"last_login of owner {owner_id} was None when damage for {object_id} was calculated.")
+            continue
+        # calculate the damage percentage based on the time since the owner became inactive relative to PURGE
+        dmg = 1 - time_since_inactive / PURGE
+        # if damage >= 100% the objects are removed from db
+        if dmg <= 0:
+            removed.append(object_id)
+            # if owner had thralls remove those too
+            if owner_id in thralls:
+                killed.setdefault(owner_id, []).extend(thralls.pop(owner_id))
+        # if damage < 100% the object is damaged
         else:
-            num_members = len(owner.active_members(INACTIVITY)) if owner.is_guild else 1
-        diff = len(objects) - limit['max'] - num_members * per_member
-        # if allowance has been exceeded
-        if diff > 0:
-            logger.info(f"Deleting the following objects from {owner.name} ({owner.id}):")
-            # pick diff amount of object_ids from the objects list and remove them from the db
-            picked_objects = random.sample(objects, diff)
-            picked_object_ids = []
-            for obj in picked_objects:
-                picked_object_ids.append(obj.id)
-                tp = f"TeleportPlayer {round(obj.x)} {round(obj.y)} {round(obj.z)}"
-                logger.info(f"{obj.class_[obj.class_.rfind('.')+1:]} ({obj.id}): {tp}")
-            Tiles.remove(picked_object_ids, autocommit=False)
-
-""" Delete old characters from the db and clean up behind them """
-logger.debug("Deleting old characters.")
-char_ids = set()
-player_ids = {}
-# get all characters who logged in before a configured time
-filter = (Characters._last_login <= lia_ts) & Characters.id.notin_(OWNER_WHITELIST)
-deleted_chars = tuple(session.query(Characters).filter(filter).all())
-for char in deleted_chars:
-    user = char.user
-    if user:
-        player = f"{user.disc_user} ({user.disc_id}) with FuncomID {user.funcom_id} and PlayerID {char.player_id}"
-    else:
-        player = f" with FuncomID {char.account.funcom_id} and PlayerID {char.player_id}"
-    logger.info(f"Deleting {char.name} ({char.id}) belonging to player {player}.")
-    player_ids.update({char.player_id: char.name})
-    char_ids.add(char.id)
-# use Characters.remove as opposed to session.delete(char) to not just remove it from the characters table
-Characters.remove(char_ids, autocommit=False, whitelist=OWNER_WHITELIST)
-# Log all chars that have been delete this way so they can be removed in TERPO too when the server runs
-DeleteChars.add(player_ids, autocommit=False)
-
-""" Rename applicable characters/guilds to ruins or rename them back to their original names"""
-# update the OwnersCache table and load it into a dict for convenient lookup
-logger.debug("Renaming characters and guilds from and to 'Ruins'.")
-OwnersCache.update(RUINS_CLAN_ID, autocommit=False)
-ownerscache = {id: n for id, n in session.query(OwnersCache.id, OwnersCache.name).all()}
-
-# go through all Chars/Guilds named 'Ruins' that are (no longer) inactive and rename them to their original name
-for char in session.query(Characters).filter((Characters.name == 'Ruins') & (Characters._last_login > ia_ts)).all():
-    if char.id in ownerscache:
-        logger.info(f"Renaming char with id {char.id} back from 'Ruins' to '{ownerscache[char.id]}'.")
-        char.name = ownerscache[char.id]
-for guild in session.query(Guilds).filter((Guilds.name == 'Ruins') & (Guilds.id != RUINS_CLAN_ID)).all():
-    if not guild.is_inactive(INACTIVITY) and guild.id in ownerscache:
-        logger.info(f"Renaming guild with id {guild.id} back from 'Ruins' to '{ownerscache[guild.id]}'.")
-        guild.name = ownerscache[guild.id]
-
-# go through all characters that are not whitelisted, not in a guild and inactive
-filter = (Characters.id.notin_(OWNER_WHITELIST)) & (Characters.guild_id.is_(None)) & (Characters._last_login <= ia_ts)
-for char in session.query(Characters).filter(filter).order_by(Characters.id).all():
-    # do function call once and store the result to save time
-    has_tiles = char.has_tiles()
-    # if char is named Ruins but has no buildings left, rename back to original name in case they return
-    if char.name == 'Ruins' and not has_tiles and char.id in ownerscache:
-        logger.info(f"Renaming char with id {char.id} back from 'Ruins' to '{ownerscache[char.id]}'.")
-        char.name = ownerscache[char.id]
-    # if char is not named Ruins and still has buildings left, rename to ruins
-    elif char.name != 'Ruins' and has_tiles:
-        logger.info(f"Renaming char with id {char.id} from '{ownerscache[char.id]}' to 'Ruins'.")
-        char.name = 'Ruins'
-
-# go through all guilds since filtering for inactivity is more complicated there
-filter = (Guilds.id.notin_(OWNER_WHITELIST)) & (Guilds.id != RUINS_CLAN_ID)
-for guild in session.query(Guilds).filter(filter).order_by(Guilds.id).all():
-    if guild.is_inactive(INACTIVITY):
-        # do function call once and store the result to save time
-        has_tiles = guild.has_tiles()
-        # if guild has no members, delete it. This will place it's buidlings on the ObjectsCache when next updated
-        if len(guild.members) == 0:
-            session.delete(guild)
-        # if guild is named Ruins but has no buildings left, rename back to original name in case the owner(s) return
-        elif guild.name == 'Ruins' and not has_tiles and guild.id in ownerscache:
-            logger.info(f"Renaming guild with id {guild.id} back from 'Ruins' to '{ownerscache[guild.id]}'.")
-            guild.name = ownerscache[guild.id]
-        # if guild is not named Ruins and still has buildings left, rename to ruins
-        elif guild.name != 'Ruins' and has_tiles:
-            logger.info(f"Renaming guild with id {guild.id} from '{ownerscache[guild.id]}' to 'Ruins'.")
-            guild.name = 'Ruins'
-
-""" move all owner_id 0 objects to the dedicated ruins clan """
-reassigned = []
-stat_builds = session.query(StaticBuildables.id).scalar_subquery()
-for tile in session.query(Buildings).filter(Buildings.object_id.notin_(stat_builds) & (Buildings.owner_id == 0)):
-    reassigned.append(tile.object_id)
-    tile.owner_id = RUINS_CLAN_ID
-
-if len(reassigned) > 0:
-    logger.info(f"Moving owner_id 0 objects to dedicated Ruins clan: {str(reassigned)}.")
-
-""" move all ownerless objects to the dedicated ruins clan """
-logger.debug("Moving ownerless objects to dedicated ruins clan.")
-# update the ObjectsCache table and load it into a dict for convenient lookup
-ObjectsCache.update(RUINS_CLAN_ID, autocommit=False)
-objectscache = {id: ts for id, ts in session.query(ObjectsCache.id, ObjectsCache._timestamp).all()}
-
-# add all object_ids that belong to the dedicated ruins clan into a set for an easy check
-ruins_clan_query = session.query(Buildings.object_id).filter_by(owner_id=RUINS_CLAN_ID)
-ruins_clan = set(r for r, in ruins_clan_query.all())
-
-# go through all the objects that either have no owner or are in the dedicated ruins clan
-reassigned = []
-for object_id, object_ts in objectscache.items():
-    # if ownerless object is not yet in the ruins clan, move it there
-    if object_id not in ruins_clan:
-        # since ObjectsCache was just updated, it should only contain existing objects
-        reassigned.append(object_id)
-        obj = session.query(Buildings).filter_by(object_id=object_id).one()
-        obj.owner_id = RUINS_CLAN_ID
-
-if len(reassigned) > 0:
-    logger.info(f"Moving no owner objects to dedicated Ruins clan: {str(reassigned)}.")
-
-""" damage or remove buildins belonging to 'Ruins' owners """
-logger.debug("Applying damage to and removing buildings belonging to the dedicated ruins clan.")
-# index all thralls by their owners so they can be removed alongside their owners buildings
-thralls = {}
-for property in session.query(Properties).filter(Properties.name.like("%OwnerUniqueID")).all():
-    owner_id = property.owner_id
-    if owner_id in thralls:
-        thralls[owner_id] += [property.object_id]
-    else:
-        thralls[owner_id] = [property.object_id]
-
-chars_query = session.query(Characters.id).filter_by(name='Ruins')
-guilds_query = session.query(Guilds.id).filter_by(name='Ruins')
-filter = Buildings.owner_id.in_(chars_query.union(guilds_query)) & Buildings.owner_id.notin_(OWNER_WHITELIST)
-ruins_query = session.query(Buildings).filter(filter)
-damaged, removed, killed = [], [], []
-for building in ruins_query.all():
-    # if building has no owner, the time since last login needs to be determined via objectscache timestamp
-    if building.object_id in objectscache:
-        time_since_inactive = timedelta(seconds=now_ts-objectscache[building.object_id])
-    # If owner had just been deleted for inactivity assume that their buildings should also be removed
-    elif building.owner in deleted_chars:
-        time_since_inactive = INACTIVITY + PURGE
-    # otherwise use the timestamp of the last login
-    elif building.owner.last_login is not None:
-        time_since_inactive = now - building.owner.last_login - INACTIVITY
-    # should never get here but catch it anyway
-    else:
-        logger.warning(f"building.owner.last_login was None for {building} when damage was supposed to be calculated.")
-    # calculate the damage percentage based on the time since the owner became inactive relative to the PURGE timedelta
-    dmg = 1 - time_since_inactive / PURGE
-    # if damage >= 100% simply remove the objects from db
-    if dmg <= 0:
-        removed.append(building.object_id)
-        Tiles.remove(building.object_id, autocommit=False)
-        # if owner had thralls remove those too
-        if building.owner_id in thralls:
-            killed += thralls[building.owner_id]
-            Thralls.remove(thralls[building.owner_id], autocommit=False)
-            del thralls[building.owner_id]
-    # if damage < 100% damage and that part of the object isn't already more damaged than that, damage it
+            damage.setdefault(dmg, []).append(object_id)
+
+    damaged = [object_id for object_ids in damage.values() for object_id in object_ids]
+    if len(damaged) > 0:
+        logger.info(f"Damaging objects: {str(damaged)}.")
+    if len(removed) > 0:
+        logger.info(f"Removing objects: {str(removed)}.")
+    if len(killed) > 0:
+        logger.info(f"Killing thralls: {str([id for ids in killed.values() for id in ids])}.")
+    changes['remove_ruins'] = removed
+    # thralls are kept per owner so that apply can spare those of owners who have returned in the meantime
+    changes['kill_thralls'] = list(killed.items())
+    changes['damage'] = list(damage.items())
+
+    # nothing has been changed in the snapshot
+    session.rollback()
+    return changes
+
+
+def rename(model, names):
+    """
+    Renames all characters or guilds given as [(id, name), ...] with one UPDATE per chunk
+    """
+    # each chunk binds every id three times (IN list and the WHEN/THEN pairs of the CASE)
+    for chunk in chunks(names, CHUNK_SIZE // 3):
+        chunk = dict(chunk)
+        chunk_query = session.query(model).filter(model.id.in_(chunk))
+        chunk_query.update({model.name: case(chunk, value=model.id)}, synchronize_session=False)
+
+
+def get_active_owners(ia_ts):
+    """
+    Returns the ids of all characters that logged in after ia_ts together with the ids of their guilds
+    """
+    chars = session.query(Characters.id, Characters.guild_id).filter(Characters._last_login > ia_ts).all()
+    return {id for id, _ in chars} | {guild_id for _, guild_id in chars if guild_id is not None}
+
+
+def get_unclaimed(object_ids, active_owners):
+    """
+    Returns those of the given buildings that still exist and don't belong to any of active_owners
+    """
+    unclaimed = []
+    for chunk in chunks(object_ids, CHUNK_SIZE):
+        chunk_query = session.query(Buildings.object_id, Buildings.owner_id).filter(Buildings.object_id.in_(chunk))
+        unclaimed += [object_id for object_id, owner_id in chunk_query.all() if owner_id not in active_owners]
+    return unclaimed
+
+
+def cull_event_log(el_ts):
+    """
+    Deletes all events up to el_ts from the event log in batches of EVENT_LOG_CULL_BATCH events,
+    oldest first, committing after each batch. Creates an index on the event time if there's none
+    """
+    logger.debug("Culling the events log.")
+    table = GameEvents.__table__.name
+    column = GameEvents.world_time.property.columns[0].name
+    engine = engines['gamedb']
+    # check if any index of the event log starts with the event time and create one if it doesn't
+    with engine.connect() as conn:
+        indexes = [row[1] for row in conn.execute(f'PRAGMA index_list("{table}")').fetchall()]
+        indexed = any(
+            [info[2] for info in conn.execute(f'PRAGMA index_info("{index}")').fetchall()][:1] == [column]
+            for index in indexes
+        )
+    if not indexed:
+        logger.info(f"Creating index on {table}.{column}.")
+        with engine.begin() as conn:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table}_{column}" ON "{table}" ("{column}")')
+
+    statement = text(
+        f'DELETE FROM "{table}" WHERE rowid IN '
+        f'(SELECT rowid FROM "{table}" WHERE "{column}" <= :ts ORDER BY "{column}" LIMIT :limit)'
+    )
+    cull_start = time()
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            num_rows = conn.execute(statement, {'ts': el_ts, 'limit': EVENT_LOG_CULL_BATCH}).rowcount
+        deleted += num_rows
+        if num_rows > 0:
+            logger.debug(f"Culled {deleted} events so far.")
+        if num_rows < EVENT_LOG_CULL_BATCH:
+            break
+    logger.info(f"Culled {deleted} events from the events log. Required time: {time() - cull_start:.3f} sec.")
+
+
+def apply(plan):
+    """
+    Applies all changes of a plan to game.db in a single transaction
+    """
+    """ Cull the event log """
+    # done in batches of their own ahead of the transaction below to keep the rollback journal small
+    cull_event_log(plan['event_log_ts'])
+
+    apply_start = time()
+
+    # make sure a ruins clan exists
+    if session.query(Guilds).get(RUINS_CLAN_ID) is None:
+        session.add(Guilds(id=RUINS_CLAN_ID, name='Ruins'))
+
+    """ Delete some blacklisted items placed in the world """
+    logger.debug(f"Deleting {len(plan['remove_objects'])} blacklisted items.")
+    for chunk in chunks(plan['remove_objects'], CHUNK_SIZE):
+        Tiles.remove(chunk, autocommit=False)
+
+    # owners who logged in since the plan was made are spared from everything the plan decided against them
+    active_owners = get_active_owners(plan['ia_ts'])
+
+    """ Delete old characters from the db and clean up behind them """
+    logger.debug(f"Deleting {len(plan['delete_chars'])} old characters.")
+    # characters are only deleted if they still haven't logged in since the plan's threshold
+    deleted_players = set()
+    for chunk in chunks(plan['delete_chars'], CHUNK_SIZE):
+        chunk_query = session.query(Characters.id, Characters.player_id).filter(
+            Characters.id.in_(chunk) & (Characters._last_login <= plan['lia_ts'])
+        )
+        chars = chunk_query.all()
+        if len(chars) < len(chunk):
+            logger.info(f"Sparing returned characters: {str(sorted(set(chunk) - set(id for id, _ in chars)))}.")
+        deleted_players.update(player_id for _, player_id in chars)
+        # use Characters.remove as opposed to session.delete(char) to not just remove it from the characters table
+        if chars:
+            Characters.remove(set(id for id, _ in chars), autocommit=False, whitelist=OWNER_WHITELIST)
+    # Log all chars that have been delete this way so they can be removed in TERPO too when the server runs
+    players = [(player_id, name) for player_id, name in plan['deleted_players'] if player_id in deleted_players]
+    for chunk in chunks(players, CHUNK_SIZE):
+        DeleteChars.add(dict(chunk), autocommit=False)
+
+    """ Rename applicable characters/guilds to ruins or rename them back to their original names"""
+    # owners are only renamed to 'Ruins' if they're still inactive, renaming them back is always fine
+    rename_chars = [(id, name) for id, name in plan['rename_chars'] if name != 'Ruins' or id not in active_owners]
+    rename_guilds = [(id, name) for id, name in plan['rename_guilds'] if name != 'Ruins' or id not in active_owners]
+    logger.debug(f"Renaming {len(rename_chars)} characters and {len(rename_guilds)} guilds.")
+    rename(Characters, rename_chars)
+    rename(Guilds, rename_guilds)
+    # guilds are only deleted if nobody has joined them since the plan was made
+    guild_members = session.query(Characters.guild_id).filter(Characters.guild_id.isnot(None)).scalar_subquery()
+    for chunk in chunks(plan['delete_guilds'], CHUNK_SIZE):
+        chunk_query = session.query(Guilds).filter(Guilds.id.in_(chunk) & Guilds.id.notin_(guild_members))
+        chunk_query.delete(synchronize_session=False)
+
+    """ move all owner_id 0 and ownerless objects to the dedicated ruins clan """
+    logger.debug("Moving owner_id 0 and ownerless objects to dedicated ruins clan.")
+    # owner_id 0 objects are only moved if nothing has claimed them since the plan was made
+    for chunk in chunks(plan['reassign_zero'], CHUNK_SIZE):
+        chunk_query = session.query(Buildings).filter(Buildings.object_id.in_(chunk) & (Buildings.owner_id == 0))
+        chunk_query.update({Buildings.owner_id: RUINS_CLAN_ID}, synchronize_session=False)
+    # ownerless objects are only moved if they didn't get an existing owner since the plan was made
+    existing_chars = session.query(Characters.id).scalar_subquery()
+    existing_guilds = session.query(Guilds.id).scalar_subquery()
+    for chunk in chunks(plan['reassign_ownerless'], CHUNK_SIZE):
+        chunk_query = session.query(Buildings).filter(
+            Buildings.object_id.in_(chunk) & Buildings.owner_id.notin_(existing_chars)
+            & Buildings.owner_id.notin_(existing_guilds)
+        )
+        chunk_query.update({Buildings.owner_id: RUINS_CLAN_ID}, synchronize_session=False)
+
+    """ damage or remove buildins belonging to 'Ruins' owners """
+    logger.debug("Applying damage to and removing buildings belonging to the dedicated ruins clan.")
+    # buildings are only removed or damaged if they haven't been claimed by an active owner in the meantime
+    remove_ruins = get_unclaimed(plan['remove_ruins'], active_owners)
+    kill_thralls = [id for owner_id, ids in plan['kill_thralls'] if owner_id not in active_owners for id in ids]
+    # remove all buildings and thralls in chunks that stay below SQLite's limit of bound variables
+    for chunk in chunks(remove_ruins, CHUNK_SIZE):
+        Tiles.remove(chunk, autocommit=False)
+    for chunk in chunks(kill_thralls, CHUNK_SIZE):
+        Thralls.remove(chunk, autocommit=False)
+    # damage all parts of the remaining objects that aren't already more damaged than that
+    for dmg, object_ids in plan['damage']:
+        for chunk in chunks(get_unclaimed(object_ids, active_owners), CHUNK_SIZE):
+            parts = session.query(BuildableHealth).filter(
+                BuildableHealth.object_id.in_(chunk) & (BuildableHealth.health_percentage > dmg)
+            )
+            parts.update({BuildableHealth.health_percentage: dmg}, synchronize_session=False)
+
+    session.commit()
+    logger.info(f"Plan applied. Required time: {time() - apply_start:.3f} sec.")
+
+
+def maintain(name, engine):
+    """
+    Picks and runs the cheapest maintenance that's sufficient for the db behind engine.
+    A full VACUUM/REINDEX/ANALYZE/integrity_check is only done when the last one is older than
+    MAINT_FULL_INTERVAL or too many pages are free, otherwise PRAGMA optimize and quick_check suffice
+    """
+    maint_start = time()
+    with engine.connect() as conn:
+        free_pages = conn.execute('PRAGMA freelist_count').scalar()
+        pages = conn.execute('PRAGMA page_count').scalar()
+        # 2 => INCREMENTAL, freed pages can only be reclaimed with incremental_vacuum in that mode
+        incremental = conn.execute('PRAGMA auto_vacuum').scalar() == 2
+    ratio = free_pages / pages if pages else 0
+    last_full = get_state(f"maintenance.{name}.last_full")
+    if (not MAINT_ADAPTIVE or last_full is None or now_ts - last_full >= MAINT_FULL_INTERVAL.total_seconds()
+            or ratio >= MAINT_FULL_FREELIST_RATIO):
+        mode, statements = 'full', ('VACUUM', 'REINDEX', 'ANALYZE', 'PRAGMA integrity_check')
+    elif incremental and ratio >= MAINT_INCREMENTAL_FREELIST_RATIO:
+        mode, statements = 'incremental', ('PRAGMA incremental_vacuum', 'PRAGMA optimize', 'PRAGMA quick_check')
     else:
-        damaged.append(building.object_id)
-        for part in session.query(BuildableHealth).filter_by(object_id=building.object_id).all():
-            if part.health_percentage > dmg:
-                part.health_percentage = dmg
-
-if len(damaged) > 0:
-    logger.info(f"Damaging objects: {str(damaged)}.")
-if len(removed) > 0:
-    logger.info(f"Removing objects: {str(removed)}.")
-if len(killed) > 0:
-    logger.info(f"Killing thralls: {str(killed)}.")
-
-session.commit()
-logger.debug("Cleaning up the db.")
-for name, engine in engines.items():
+        mode, statements = 'optimize', ('PRAGMA optimize', 'PRAGMA quick_check')
+    logger.info(f"Maintaining {name} ({free_pages} of {pages} pages free): {mode} ({', '.join(statements)}).")
     with engine.connect() as conn:
-        conn.execute('VACUUM')
-        conn.execute('REINDEX')
-        conn.execute('ANALYZE')
-        conn.execute('PRAGMA integrity_check')
+        for statement in statements:
+            # pragmas such as incremental_vacuum only do their work while their result is being fetched
+            result = conn.execute(statement)
+            rows = [row[0] for row in result.fetchall()] if result.returns_rows else []
+            if statement.endswith('_check') and rows != ['ok']:
+                logger.error(f"{statement} of {name} reported: {str(rows)}")
         # If there are any pending changes, commit them
         if conn.in_transaction():
             conn.execute('COMMIT')
+    if mode == 'full':
+        set_state(f"maintenance.{name}.last_full", now_ts)
+    logger.info(f"Maintenance of {name} done. Required time: {time() - maint_start:.3f} sec.")
+
+
+if args.phase == 'plan':
+    try:
+        ruins_plan = plan()
+    finally:
+        # release the snapshot before removing it, it's taken anew by every plan phase
+        session.close()
+        engines['gamedb'].dispose()
+        os.remove(RUINS_SNAPSHOT_PATH)
+    with open(args.plan, 'w') as f:
+        json.dump(ruins_plan, f)
+    logger.info(f"Plan written to {args.plan}.")
+else:
+    with open(args.plan, 'r') as f:
+        ruins_plan = json.load(f)
+    # a plan that's too old may no longer reflect the state of game.db
+    if now_ts - ruins_plan['created'] > RUINS_PLAN_MAX_AGE.total_seconds():
+        logger.error(f"Plan {args.plan} is older than {RUINS_PLAN_MAX_AGE}. Create a new one with the plan phase.")
+        sys.exit(1)
+    apply(ruins_plan)
+
+    logger.debug("Cleaning up the db.")
+    # the databases are independent from each other so they can be maintained in parallel
+    with ThreadPoolExecutor(max_workers=max(len(engines), 1)) as executor:
+        for future in [executor.submit(maintain, name, engine) for name, engine in engines.items()]:
+            future.result()
 
+logger.info(f"Peak memory usage ({args.phase}): {peak_memory():.1f} MiB.")
 exec_time = time() - start_time
 if LOG_LEVEL_STDOUT > logging.INFO:
     print(f"Done! Required time: {exec_time:.3f} sec.")
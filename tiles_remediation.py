@@ -2,9 +2,10 @@ import sys
 import logging
 from datetime import datetime
 from operator import itemgetter
-from exiles_api import session, Characters, Guilds, TilesManager
+from exiles_api import session
 from google_api.sheets import Spreadsheet
 from logger import get_logger
+from lookups import get_owner_summary, get_tiles_by_owner
 from config import (
     TILES_MGMT_SPREADSHEET_ID, TILES_MGMT_SHEET_ID, OWNER_WHITELIST, BUILDING_TILE_MULT, PLACEBALE_TILE_MULT,
     ALLOWANCE_INCLUDES_INACTIVES, ALLOWANCE_BASE, ALLOWANCE_CLAN, INACTIVITY, LOG_LEVEL_STDOUT, LOG_LEVEL_FILE,
@@ -38,36 +39,38 @@ sheets = Spreadsheet(TILES_MGMT_SPREADSHEET_ID, activeSheetId=TILES_MGMT_SHEET_I
 date_str = now.strftime("%d-%b-%Y")
 values = []
 logger.debug("Gather tiles statistics.")
-building_pieces, placeables = TilesManager.get_tiles_by_owner(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT, do_round=False)
+building_pieces, placeables = get_tiles_by_owner(BUILDING_TILE_MULT, PLACEBALE_TILE_MULT, do_round=False)
+logger.debug("Gather owner summary.")
+summary = get_owner_summary(INACTIVITY)
 # Compile the list for all guilds
-for guild in session.query(Guilds).all():
+for guild_id, guild in summary['guilds'].items():
     # Whitelisted owners are ignored
-    if guild.id in OWNER_WHITELIST:
+    if guild_id in OWNER_WHITELIST:
         continue
     # Ruins are ignored
-    if guild.name == 'Ruins':
+    if guild['name'] == 'Ruins':
         continue
     # Discard guilds with no tiles
-    if guild.id not in building_pieces:
+    if guild_id not in building_pieces:
         continue
     # building pices
-    buildingPieces = building_pieces[guild.id]
+    buildingPieces = building_pieces[guild_id]
     # the adjusted number of placeables
-    placeablesAdjusted = placeables[guild.id]
+    placeablesAdjusted = placeables[guild_id]
     # Number of tiles taking bMult and pMult into account
     totalTiles = buildingPieces + placeablesAdjusted
     # list of guild members
-    members = guild.members
+    members = guild['members']
     if ALLOWANCE_INCLUDES_INACTIVES:
         # allowedTilesTotal is the base allowance + clan allowance per additional member
         allowedTilesTotal = ALLOWANCE_BASE + (len(members) - 1) * ALLOWANCE_CLAN
         memberStr = len(members)
     else:
         # if there are no active players in the clan disregard
-        if len(members.active(INACTIVITY)) == 0:
+        if guild['num_active'] == 0:
             continue
-        allowedTilesTotal = ALLOWANCE_BASE + (len(members.active(INACTIVITY)) - 1) * ALLOWANCE_CLAN
-        memberStr = str(len(members.active(INACTIVITY))) + ' / ' + str(len(members))
+        allowedTilesTotal = ALLOWANCE_BASE + (guild['num_active'] - 1) * ALLOWANCE_CLAN
+        memberStr = str(guild['num_active']) + ' / ' + str(len(members))
 
     # allowedPlaceables is a ratio of the total tiles
     allowedPlaceables = allowedTilesTotal * PLACEBALE_TILE_RATIO
@@ -78,17 +81,14 @@ for guild in session.query(Guilds).all():
     excessPlaceables = max(placeablesAdjusted - allowedPlaceables, 0)
 
     allMembers = tuple(
-        (m.name, (m.user.disc_user if m.user else ''), m.rank_name, m.last_login.strftime("%d-%b-%Y")) for m in members
+        (m['name'], m['disc_user'], m['rank_name'], m['last_login'].strftime("%d-%b-%Y")) for m in members
     )
     allMemberNames = "\n".join((m[0] + (' (' + m[1] + ')' if m[1] else '') for m in allMembers))
     allMemberRanks = "\n".join((m[2] for m in allMembers))
     allMemberLogin = "\n".join((m[3] for m in allMembers))
-    if guild.members.last_to_login and guild.members.last_to_login.user:
-        disc_user = guild.members.last_to_login.user.disc_user
-    else:
-        disc_user = ''
+    disc_user = guild['last_to_login']['disc_user'] if guild['last_to_login'] else ''
     values.append([
-        guild.name,                         # Owner
+        guild['name'],                      # Owner
         disc_user,                          # Discord Name (last to login)
         allMemberNames,                     # (Char Name Discord Name)
         allMemberRanks,                     # (Rank)
@@ -105,20 +105,20 @@ for guild in session.query(Guilds).all():
 
 # Compile the list for all characters
 logger.debug("Compile character tiles statistics.")
-for character in session.query(Characters).all():
+for character in summary['characters'].values():
     # Whitelisted owners are ignored
-    if character.id in OWNER_WHITELIST:
+    if character['id'] in OWNER_WHITELIST:
         continue
     # Discard characters that are in a guild or inactive
-    if character.has_guild or character.is_inactive(INACTIVITY):
+    if character['guild_id'] is not None or not character['is_active']:
         continue
     # Discard characters with no tiles
-    if character.id not in building_pieces:
+    if character['id'] not in building_pieces:
         continue
     # building pices
-    buildingPieces = building_pieces[character.id]
+    buildingPieces = building_pieces[character['id']]
     # the adjusted number of placeables
-    placeablesAdjusted = placeables[character.id]
+    placeablesAdjusted = placeables[character['id']]
     # Number of tiles taking bMult and pMult into account
     totalTiles = buildingPieces + placeablesAdjusted
     # allowedPlaceables is a ratio of the total tiles
@@ -129,24 +129,22 @@ for character in session.query(Characters).all():
     excessTotal = max(totalTiles - ALLOWANCE_BASE, 0)
     excessPlaceables = max(placeablesAdjusted - allowedPlaceables, 0)
 
-    fullName = character.name + (
-        ' (' + character.user.disc_user + ')' if character.user and character.user.disc_user else ''
-    )
-    disc_user = character.user.disc_user if character.user else ''
+    disc_user = character['disc_user']
+    fullName = character['name'] + (' (' + disc_user + ')' if disc_user else '')
     values.append([
-        character.name,                             # Owner
-        disc_user,                                  # Discord Name (last to login)
-        fullName,                                   # (Char Name Discord Name)
-        character.rank_name,                        # (Rank)
-        character.last_login.strftime("%d-%b-%Y"),  # (Last Login)
-        1,                                          # Members (active / total)
-        int(round(totalTiles, 0)),                  # Building Pieces
-        int(round(placeablesAdjusted, 0)),          # Placeables (adjusted)
-        int(round(totalTiles, 0)),                  # Tiles (total)
-        int(round(excessPlaceables, 0)),            # (excess placeables)
-        int(round(excessTotal, 0)),                 # (excess total)
-        int(round(allowedPlaceables, 0)),           # (allowance placeables)
-        ALLOWANCE_BASE                              # (allowance total)
+        character['name'],                              # Owner
+        disc_user,                                      # Discord Name (last to login)
+        fullName,                                       # (Char Name Discord Name)
+        character['rank_name'],                         # (Rank)
+        character['last_login'].strftime("%d-%b-%Y"),  # (Last Login)
+        1,                                              # Members (active / total)
+        int(round(totalTiles, 0)),                      # Building Pieces
+        int(round(placeablesAdjusted, 0)),              # Placeables (adjusted)
+        int(round(totalTiles, 0)),                      # Tiles (total)
+        int(round(excessPlaceables, 0)),                # (excess placeables)
+        int(round(excessTotal, 0)),                     # (excess total)
+        int(round(allowedPlaceables, 0)),               # (allowance placeables)
+        ALLOWANCE_BASE                                  # (allowance total)
     ])
 session.close()
 